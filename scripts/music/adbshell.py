@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import os
+import posixpath
+import shlex
+import subprocess
+import sys
+import threading
+import uuid
+
+ADB = os.environ.get('ADB', 'adb')
+
+Result = collections.namedtuple('Result', 'code output')
+
+
+def quote(path):
+    return shlex.quote(os.fsdecode(path))
+
+
+def braces(pattern):
+    # the {a,b} alternatives bash/mksh would expand, as separate patterns
+    head, brace, tail = pattern.partition('{')
+    if not brace:
+        return [pattern]
+    alternatives, _, rest = tail.partition('}')
+    return [expanded for alternative in alternatives.split(',') for expanded in braces(head + alternative + rest)]
+
+
+# one xargs batch: "N\n", the stat line of each file, ".\n", then the N names NUL-terminated; if a file
+# vanished between find and stat, the batch is stat'ed again one by one with "- -" for the missing ones,
+# so the lines stay aligned with the names
+FIND_BATCH = r'''printf '%d\n' $#
+s=$(stat -c '%Y %s' "$@" 2>/dev/null) || s=$(for f; do stat -c '%Y %s' "$f" 2>/dev/null || echo '- -'; done)
+printf '%s\n.\n' "$s"; printf '%s\0' "$@"'''
+
+
+class Reader:
+    # delimiter-split reads straight off a pipe, holding at most one block plus one record
+
+    def __init__(self, stream):
+        self.stream, self.buffer = stream, b''
+
+    def until(self, delimiter):
+        while (i := self.buffer.find(delimiter)) == -1:
+            data = self.stream.read1(1 << 16)
+            if not data:
+                return None
+            self.buffer += data
+        record, self.buffer = self.buffer[:i], self.buffer[i + 1:]
+        return record
+
+
+class ShellError(Exception):
+    def __init__(self, command, code, output):
+        super().__init__(f'{command!r} exited with {code}: {output.decode(errors="replace").strip()}')
+        self.command, self.code, self.output = command, code, output
+
+
+class Shell:
+    # one long-lived `adb shell`; every command runs in a subshell (so exit/cd can't break the session)
+    # followed by a printf of a random marker and $?, so output and exit code can be cut out of the
+    # stream. Commands are shell text: globs are expanded on the device, literal paths go through quote().
+
+    def __init__(self, serial=None, retries=3, wait=10):
+        self.args = [ADB] + (['-s', serial] if serial else [])
+        self.retries = retries
+        self.wait = wait  # seconds to wait for the device to come back before each retry
+        self.marker = f'__adbshell_{uuid.uuid4().hex}__'.encode()
+        self.proc = None
+        self.lock = threading.Lock()  # one command in flight; threads queue up
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        self.proc = subprocess.Popen(self.args + ['shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self.buffer = b''
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
+
+    def run(self, command, stderr=True):
+        with self.lock:
+            return self.retry(command, stderr)
+
+    def retry(self, command, stderr):
+        for attempt in range(self.retries + 1):
+            if self.proc is None:
+                self.connect()
+            try:
+                return self.exchange(command, stderr)
+            except (OSError, EOFError) as e:
+                self.close()
+                if attempt == self.retries:
+                    raise ConnectionError(f'adb shell lost running {command!r}') from e
+                try:
+                    subprocess.run(self.args + ['wait-for-device'], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL, timeout=self.wait)
+                except subprocess.TimeoutExpired:
+                    pass  # the next attempt fails fast and counts against retries
+
+    def exchange(self, command, stderr):
+        redirect = '2>&1' if stderr else '2>/dev/null'
+        self.proc.stdin.write(f'( {command}\n) </dev/null {redirect}; '
+                              f'printf "\\n%s %d\\n" {self.marker.decode()} $?\n'.encode(errors='surrogateescape'))
+        self.proc.stdin.flush()
+        tag = b'\n' + self.marker + b' '
+        while (start := self.buffer.find(tag)) == -1 or self.buffer.find(b'\n', start + len(tag)) == -1:
+            data = self.proc.stdout.read1(1 << 16)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        end = self.buffer.index(b'\n', start + len(tag))
+        output, code = self.buffer[:start], int(self.buffer[start + len(tag):end])
+        self.buffer = self.buffer[end + 1:]
+        return Result(code, output)
+
+    def check(self, command, stderr=True):
+        result = self.run(command, stderr)
+        if result.code:
+            raise ShellError(command, result.code, result.output)
+        return result.output
+
+    def ls(self, *patterns):
+        # patterns matching nothing are not an error
+        output = self.run('ls -1d ' + ' '.join(patterns), stderr=False).output
+        return [os.fsdecode(line) for line in output.split(b'\n') if line]
+
+    def stat(self, *patterns):
+        output = self.run("stat -c '%Y %s %n' " + ' '.join(patterns), stderr=False).output
+        index = {}
+        for line in output.split(b'\n'):
+            if line:
+                mtime, size, path = line.split(b' ', 2)
+                index[os.fsdecode(path)] = (int(mtime), int(size))
+        return index
+
+    def find(self, *patterns):
+        # (path, mtime, size) for every regular file the dir/glob patterns match, streamed through a
+        # separate exec-out with NUL-separated names, so any byte sequence survives (as surrogateescape)
+        dirs = {}
+        for pattern in patterns:
+            for expanded in braces(pattern):
+                directory, name = posixpath.split(expanded)
+                dirs.setdefault(directory or '.', []).append(name)
+        finds = []
+        for directory, names in dirs.items():
+            tests = ' -o '.join('-name ' + quote(name) for name in names)
+            finds.append(f'find {quote(directory)} -maxdepth 1 -type f \\( {tests} \\) -print0')
+        # exec-out doesn't always pass the exit status on, so the listing only counts with its "end 0" line
+        command = ('{ ' + '; '.join(finds) + '; } 2>/dev/null | xargs -0 -r sh -c ' + shlex.quote(FIND_BATCH)
+                   + " sh; printf 'end %d\\n' $?")
+        proc = subprocess.Popen(self.args + ['exec-out', command], stdout=subprocess.PIPE)
+        reader = Reader(proc.stdout)
+        end = None
+        try:
+            while (header := reader.until(b'\n')) is not None:
+                if header.startswith(b'end '):
+                    end = header
+                    break
+                stats = []
+                while (line := reader.until(b'\n')) not in (b'.', None):
+                    stats.append(line.split())
+                names = [reader.until(b'\0') for _ in range(int(header))]
+                if len(stats) != len(names) or None in names:
+                    # a partial listing would look like deleted files to whoever acts on it
+                    raise ConnectionError(f'adbshell: listing batch of {len(names)} came back with {len(stats)}'
+                                          ' stat lines')
+                for (mtime, size), name in zip(stats, names):
+                    if mtime != b'-':  # gone since find saw it
+                        yield os.fsdecode(name), int(mtime), int(size)
+        finally:
+            proc.stdout.close()
+            code = proc.wait()
+        if code or end != b'end 0':
+            raise ConnectionError(f'adbshell: listing cut short (adb exited {code}, '
+                                  f'{end.decode() if end else "no end marker"})')
+
+    def mkdir(self, path):
+        self.check('mkdir -p ' + quote(path))
+
+    def rm(self, *paths):
+        self.check('rm -f ' + ' '.join(map(quote, paths)))
+
+    def mv(self, src, dst):
+        self.check(f'mv {quote(src)} {quote(dst)}')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('commands', nargs='+', help='run each over the same shell session')
+    ap.add_argument('-s', '--serial')
+    args = ap.parse_args()
+    code = 0
+    with Shell(args.serial) as shell:
+        for command in args.commands:
+            result = shell.run(command)
+            sys.stdout.buffer.write(result.output)
+            sys.stdout.flush()
+            code = code or result.code
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import decode
+import lufs
+
+
+FIXTURES_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'music-bench')
+CODECS = {
+    'flac': ['-f', 'flac', '-c:a', 'flac', '-sample_fmt', 's16'],
+    'mp3': ['-f', 'mp3', '-c:a', 'libmp3lame', '-b:a', '320k'],
+}
+
+
+def synthesize(seconds, channels, rate, seed=0):
+    # a few drifting tones over brown-ish noise, louder in the middle; same seed, same samples
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    noise = np.cumsum(rng.standard_normal((len(t), channels)), axis=0)
+    noise -= np.linspace(noise[0], noise[-1], len(t))
+    noise *= 0.05 / (np.abs(noise).max() or 1)
+    tones = sum(0.1 * np.sin(2 * np.pi * f * t * (1 + 0.01 * np.sin(t))) for f in (110, 440, 1760, 7040))
+    envelope = 0.3 + 0.7 * np.sin(np.pi * t / seconds)
+    return ((noise + tones[:, None]) * envelope[:, None]).astype(np.float32)
+
+
+def make_fixture(directory, codec, seconds, channels, rate):
+    path = os.path.join(directory, f'{codec}-{seconds}s-{channels}ch-{rate}.{codec}')
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        audio = synthesize(seconds, channels, rate)
+        subprocess.run([decode.FFMPEG, '-v', 'error', '-y', '-f', 'f32le', '-ar', str(rate), '-ac', str(channels),
+                        '-i', '-', *CODECS[codec], '-fflags', '+bitexact', '-map_metadata', '-1', path + '.part'],
+                       input=audio.tobytes(), check=True)
+        os.replace(path + '.part', path)
+    return path
+
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed(stages, name, seconds, size, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    wall = time.perf_counter() - start
+    stages[name] = dict(wall=wall, audio_x=seconds / wall, mb_s=size / wall / 1e6, maxrss_kb=maxrss())
+    return result
+
+
+def run_fixture(path, repeat):
+    # runs in a fresh process so maxrss only covers this fixture
+    lufs.CACHE_PATH = os.path.join(os.path.dirname(path), 'lufs.sqlite')
+    size = os.stat(path).st_size
+    best = {}
+    for _ in range(repeat):
+        stages = {}
+        audio, rate = timed(stages, 'read_audio', 0, size, lufs.read_audio, path)
+        seconds = len(audio) / rate
+        stages['read_audio'].update(audio_x=seconds / stages['read_audio']['wall'])
+        pcm = audio.nbytes
+        loudness = timed(stages, 'calculate_lufs', seconds, pcm, lufs.calculate_lufs, audio, rate)
+        peak = timed(stages, 'calculate_peak', seconds, pcm, lufs.calculate_peak, audio)
+        del audio
+
+        copy = path + '.tagged' + os.path.splitext(path)[1]
+        shutil.copyfile(path, copy)
+        try:
+            timed(stages, 'set_replaygain', seconds, size, lufs.set_replaygain, copy, -20 - loudness, peak)
+            timed(stages, 'set_replaygain_unchanged', seconds, size, lufs.set_replaygain, copy, -20 - loudness, peak)
+        finally:
+            os.unlink(copy)
+        for name, stage in stages.items():
+            if name not in best or stage['wall'] < best[name]['wall']:
+                best[name] = stage
+    return dict(seconds=seconds, size=size, lufs=loudness, peak=peak, stages=best)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    old, new = (json.load(open(path)) for path in (old_path, new_path))
+    before = {(r['fixture'], name): stage['wall'] for r in old['results'] for name, stage in r['stages'].items()}
+    for result in new['results']:
+        for name, stage in result['stages'].items():
+            if (result['fixture'], name) in before:
+                ratio = stage['wall'] / before[result['fixture'], name]
+                print(f'{result["fixture"]:32} | {name:24} | {ratio:6.2f}x' + (' !' if ratio > 1.1 else ''))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-o', '--output', default='bench.json')
+    ap.add_argument('--fixtures', default=FIXTURES_DIR)
+    ap.add_argument('--codecs', nargs='+', choices=CODECS, default=list(CODECS))
+    ap.add_argument('--lengths', nargs='+', type=int, default=[30, 300])
+    ap.add_argument('--channels', nargs='+', type=int, default=[1, 2])
+    ap.add_argument('--rates', nargs='+', type=int, default=[44100, 48000])
+    ap.add_argument('-r', '--repeat', type=int, default=3)
+    ap.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for codec, seconds, channels, rate in itertools.product(args.codecs, args.lengths, args.channels, args.rates):
+        path = make_fixture(args.fixtures, codec, seconds, channels, rate)
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_fixture, (path, args.repeat))
+        result.update(fixture=os.path.basename(path), codec=codec, channels=channels, rate=rate)
+        results.append(result)
+        print(f'{result["fixture"]:32} | ' + ' | '.join(
+            f'{name} {stage["audio_x"]:.0f}x {stage["mb_s"]:.0f}MB/s' for name, stage in result['stages'].items()
+        ) + f' | {max(stage["maxrss_kb"] for stage in result["stages"].values()) / 1024:.0f}MB', file=sys.stderr)
+
+    meta = dict(revision=git_revision(), time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, machine=platform.machine(), cpus=os.cpu_count(), backends=list(decode.BACKENDS))
+    with open(args.output, 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
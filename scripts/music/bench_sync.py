@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEADB = os.path.join(HERE, 'fakeadb.py')
+REMOTE = 'storage/emulated/0/qqmusic/song'  # one of sync.py's remote_dirs
+PUSH_REMOTE = 'storage/emulated/0/song'     # where push.py puts things
+
+# (name, script, args, remote library present, local library present)
+SCENARIOS = [
+    ('status', 'sync.py', [], True, True),
+    ('create', 'sync.py', ['-c'], True, False),
+    ('create-tar', 'sync.py', ['-c', '--tar'], True, False),
+    ('upload-create', 'sync.py', ['-C'], False, True),
+    ('push', 'push.py', [], False, True),
+]
+
+
+def make_library(directory, count, seed=0, mtime=1_600_000_000):
+    # not real audio, just the names, sizes and mtimes the sync scripts look at
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        path = os.path.join(directory, f'track {i:05d}.' + ('flac' if i % 3 == 0 else 'mp3'))
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(rng.randint(2 << 10, 64 << 10)))
+        os.utime(path, (mtime + i, mtime + i))
+
+
+def run_scenario(work, library, count, scenario, env):
+    name, script, args, remote, local = scenario
+    root = os.path.join(work, 'device')
+    cwd = os.path.join(work, 'local')
+    shutil.rmtree(root, ignore_errors=True)
+    shutil.rmtree(cwd, ignore_errors=True)
+    os.makedirs(os.path.join(root, REMOTE))
+    os.makedirs(os.path.join(root, PUSH_REMOTE))
+    if remote:
+        shutil.copytree(library, os.path.join(root, REMOTE), dirs_exist_ok=True)
+    if local:
+        shutil.copytree(library, cwd)
+    else:
+        os.makedirs(cwd)
+
+    log = os.path.join(work, 'adb.log')
+    open(log, 'w').close()
+    env = dict(env, ADB=FAKEADB, FAKEADB_ROOT=root, FAKEADB_LOG=log)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.join(HERE, script), *args], cwd=cwd, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    with open(log) as f:
+        calls = [line.split(' ', 1)[0] for line in f]
+    return dict(scenario=name, files=count, wall=wall, adb_calls=len(calls), ok=proc.returncode == 0,
+                calls={kind: calls.count(kind) for kind in sorted(set(calls))},
+                error=proc.stderr.decode(errors='replace')[-500:] if proc.returncode else None)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', '--files', nargs='+', type=int, default=[100, 1000, 10000])
+    ap.add_argument('-s', '--scenarios', nargs='+', choices=[s[0] for s in SCENARIOS], default=[s[0] for s in SCENARIOS])
+    ap.add_argument('-l', '--latency', type=float, default=0.005, help='seconds per adb call and shell round trip')
+    ap.add_argument('-b', '--bandwidth', type=float, default=20e6, help='bytes/s, 0 for unlimited')
+    ap.add_argument('-j', '--jobs', type=int, help='pass -j to the scripts')
+    ap.add_argument('-o', '--output', help='also write the results as json')
+    args = ap.parse_args()
+
+    env = dict(os.environ, FAKEADB_LATENCY=str(args.latency), FAKEADB_BANDWIDTH=str(args.bandwidth))
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-sync-') as work:
+        for count in args.files:
+            library = os.path.join(work, f'library-{count}')
+            make_library(library, count)
+            for scenario in SCENARIOS:
+                if scenario[0] not in args.scenarios:
+                    continue
+                if args.jobs:
+                    scenario = scenario[:2] + (scenario[2] + ['-j', str(args.jobs)],) + scenario[3:]
+                result = run_scenario(work, library, count, scenario, env)
+                results.append(result)
+                print(f'{result["scenario"]:14} | {count:6} files | {result["wall"]:8.2f}s | '
+                      f'{result["adb_calls"]:6} adb calls' + ('' if result['ok'] else ' | FAILED'), flush=True)
+                if result['error']:
+                    print(result['error'], file=sys.stderr)
+
+    if args.output:
+        meta = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), latency=args.latency, bandwidth=args.bandwidth)
+        with open(args.output, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
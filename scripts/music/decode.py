@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import mutagen
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+FFMPEG = os.environ.get('FFMPEG', 'ffmpeg')
+FFPROBE = os.environ.get('FFPROBE', 'ffprobe')
+CHUNK_FRAMES = 1 << 16
+
+
+class Decoder:
+    # yields float32 (frames, channels) blocks; rate, channels, bits and frames
+    # (None when the container doesn't say) are known before the first read
+
+    name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.chunks()
+
+    def chunks(self, chunk_frames=CHUNK_FRAMES):
+        buf = np.empty((chunk_frames, self.channels), np.float32)
+        while n := self.readinto(buf):
+            yield buf[:n]
+
+    def read(self):
+        audio = np.empty((self.frames or CHUNK_FRAMES, self.channels), np.float32)
+        n = self.readinto(audio)
+        if n < len(audio):
+            return audio[:n]
+        rest = [audio] + [chunk.copy() for chunk in self]
+        return np.concatenate(rest) if len(rest) > 1 else audio
+
+    def readinto(self, buf):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FfmpegDecoder(Decoder):
+    # raw f32le straight from an ffmpeg pipe into the caller's buffer, no temp files
+
+    name = 'ffmpeg'
+
+    def __init__(self, path, rate=None, channels=None):
+        self.rate, self.channels, self.bits, self.frames = probe(path)
+        if rate and rate != self.rate:
+            self.rate, self.frames = rate, None
+        if channels:
+            self.channels = channels
+        self.proc = subprocess.Popen([FFMPEG, '-v', 'error', '-nostdin', '-i', path, '-map', '0:a:0',
+                                      '-ar', str(self.rate), '-ac', str(self.channels), '-f', 'f32le', '-'],
+                                     stdout=subprocess.PIPE)
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        n = 0
+        while n < len(view) and (got := self.proc.stdout.readinto(view[n:])):
+            n += got
+        return n // (4 * self.channels)
+
+    def close(self):
+        finished = self.proc.stdout.read(1) == b''
+        self.proc.stdout.close()
+        if not finished:
+            self.proc.kill()
+        if self.proc.wait() != 0 and finished:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+
+
+class SoundfileDecoder(Decoder):
+    # native FLAC/WAV decoding through libsndfile
+
+    name = 'soundfile'
+
+    def __init__(self, path, rate=None, channels=None):
+        if rate or channels:
+            raise ValueError('soundfile backend does not resample or remix')
+        self.file = soundfile.SoundFile(path)
+        self.rate, self.channels, self.frames = self.file.samplerate, self.file.channels, self.file.frames
+        self.bits = {'PCM_S8': 8, 'PCM_U8': 8, 'PCM_16': 16, 'PCM_24': 24, 'PCM_32': 32}.get(self.file.subtype)
+
+    def readinto(self, buf):
+        return len(self.file.read(len(buf), dtype='float32', out=buf))
+
+    def close(self):
+        self.file.close()
+
+
+BACKENDS = {'ffmpeg': FfmpegDecoder}
+if soundfile is not None:
+    BACKENDS['soundfile'] = SoundfileDecoder
+
+PREFERRED = {
+    '.flac': ('soundfile', 'ffmpeg'),
+    '.wav': ('soundfile', 'ffmpeg'),
+}
+
+
+def probe(path):
+    audio = mutagen.File(path)
+    info = audio.info if audio is not None else None
+    if info is not None and info.sample_rate and info.channels:
+        frames = getattr(info, 'total_samples', None) or None
+        return info.sample_rate, info.channels, getattr(info, 'bits_per_sample', None), frames
+    out = subprocess.check_output([FFPROBE, '-v', 'error', '-select_streams', 'a:0', '-of', 'json', '-show_entries',
+                                   'stream=sample_rate,channels,bits_per_raw_sample', path])
+    stream = json.loads(out)['streams'][0]
+    return int(stream['sample_rate']), int(stream['channels']), int(stream.get('bits_per_raw_sample') or 0) or None, None
+
+
+def open_audio(path, backend=None, rate=None, channels=None):
+    if backend is not None:
+        return BACKENDS[backend](path, rate=rate, channels=channels)
+    names = PREFERRED.get(os.path.splitext(path)[1].lower(), ('ffmpeg',))
+    if rate or channels:
+        names = ('ffmpeg',)
+    # a backend that can't open the file (libsndfile on a FLAC with an ID3v2 tag in front, say) hands
+    # over to the next one
+    names = [name for name in names if name in BACKENDS]
+    for i, name in enumerate(names):
+        try:
+            return BACKENDS[name](path, rate=rate, channels=channels)
+        except Exception:
+            if i == len(names) - 1:
+                raise
+    raise ValueError(f'no decoder for {path}')
+
+
+def bench(paths, backends, repeat):
+    for name in backends:
+        size = pcm = 0
+        elapsed = 0.0
+        for path in paths:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                try:
+                    with open_audio(path, backend=name) as decoder:
+                        for chunk in decoder:
+                            pcm += chunk.nbytes
+                except Exception as e:
+                    print(f'{name} | {path} | {type(e).__name__}: {e}', file=sys.stderr)
+                    continue
+                elapsed += time.perf_counter() - start
+                size += os.stat(path).st_size
+        if elapsed:
+            print(f'{name:10} | {size / elapsed / 1e6:8.1f} MB/s file | {pcm / elapsed / 1e6:8.1f} MB/s pcm')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('paths', nargs='+')
+    ap.add_argument('-b', '--backend', action='append', choices=BACKENDS)
+    ap.add_argument('-r', '--repeat', type=int, default=3)
+    args = ap.parse_args()
+    bench(args.paths, args.backend or list(BACKENDS), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import decode
+import lufs
+
+INDEX_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'dupes.sqlite')
+INDEX_VERSION = 1
+
+# Haitsma/Kalker style: 0.37s frames every 46ms, 33 log-spaced bands between 300 and 2000Hz, one bit per
+# band pair for the sign of the energy difference's change between frames -> one uint32 per frame
+RATE = 11025
+FRAME = 4096
+HOP = 512
+EDGES = np.geomspace(300, 2000, 34)
+
+# bit-sampling LSH over the 32-bit subprints: a key is the subprint under one of these masks, so a frame
+# still collides when its bit errors fall outside a mask; only every STRIDE-th frame is stored, while
+# lookups use all of them, so any time offset still lines up
+MASKS = (0xffffff00, 0x00ffffff, 0xff00ffff)
+STRIDE = 8
+MIN_HITS = 4
+MAX_KEY_TRACKS = 32  # keys shared by more tracks than this are silence/noise and carry nothing
+
+BER = 0.35
+MIN_OVERLAP = 0.5
+
+_index = None
+
+
+def open_index():
+    global _index
+    if _index is None:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        _index = sqlite3.connect(INDEX_PATH, timeout=60)
+        if _index.execute('pragma user_version').fetchone()[0] != INDEX_VERSION:
+            _index.execute('drop table if exists tracks')
+            _index.execute('drop table if exists keys')
+            _index.execute(f'pragma user_version = {INDEX_VERSION}')
+        _index.execute('create table if not exists tracks (id integer primary key, path text unique, size integer,'
+                       ' mtime integer, codec text, bits integer, rate integer, kbps real, duration real,'
+                       ' fingerprint blob)')
+        _index.execute('create table if not exists keys (key integer, track integer, pos integer)')
+        _index.execute('create index if not exists keys_key on keys (key)')
+        _index.execute('create index if not exists keys_track on keys (track)')
+    return _index
+
+
+def band_matrix():
+    freqs = np.fft.rfftfreq(FRAME, 1 / RATE)
+    band = np.searchsorted(EDGES, freqs, side='right') - 1
+    matrix = np.zeros((len(freqs), len(EDGES) - 1), dtype=np.float32)
+    inside = (band >= 0) & (band < len(EDGES) - 1)
+    matrix[inside, band[inside]] = 1
+    return matrix
+
+
+def fingerprint(audio, block=1024):
+    # uint32 per hop, bit 31 for the lowest band pair
+    audio = audio.reshape(len(audio), -1).mean(axis=1, dtype=np.float32)
+    if len(audio) < FRAME + HOP:
+        return np.zeros(0, dtype=np.uint32)
+    frames = np.lib.stride_tricks.sliding_window_view(audio, FRAME)[::HOP]
+    window, bands = np.hanning(FRAME).astype(np.float32), band_matrix()
+    energy = np.concatenate([np.abs(np.fft.rfft(frames[i:i + block] * window)) ** 2 @ bands
+                             for i in range(0, len(frames), block)])
+    diff = energy[:, :-1] - energy[:, 1:]
+    bits = diff[1:] - diff[:-1] > 0
+    return np.packbits(bits, axis=1).view('>u4').ravel().astype(np.uint32)
+
+
+def lsh_keys(prints, stride=1):
+    # (key, pos) pairs; near-silent frames (almost all bits equal) are left out
+    pos = np.arange(0, len(prints), stride)
+    prints = prints[pos]
+    ones = np.bitwise_count(prints)
+    pos, prints = pos[(ones > 3) & (ones < 29)], prints[(ones > 3) & (ones < 29)]
+    keys = [(np.int64(table) << 32 | (prints & mask).astype(np.int64), pos) for table, mask in enumerate(MASKS)]
+    return np.concatenate([k for k, _ in keys]), np.concatenate([p for _, p in keys])
+
+
+def analyze(path):
+    info = lufs.show_audio(path)
+    with decode.open_audio(path, rate=RATE, channels=1) as decoder:
+        prints = fingerprint(decoder.read())
+    return dict(info, fingerprint=prints.tobytes())
+
+
+def run_task(path):
+    try:
+        return analyze(path)
+    except Exception as e:
+        return dict(path=path, error=f'{type(e).__name__}: {e}')
+
+
+def store(db, record, st):
+    db.execute('delete from keys where track in (select id from tracks where path = ?)', (record['path'],))
+    db.execute('delete from tracks where path = ?', (record['path'],))
+    track = db.execute('insert into tracks (path, size, mtime, codec, bits, rate, kbps, duration, fingerprint)'
+                       ' values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (record['path'], st.st_size, st.st_mtime_ns, record['codec'], record['bits'], record['rate'],
+                        record['kbps'], record['duration'], record['fingerprint'])).lastrowid
+    keys, pos = lsh_keys(np.frombuffer(record['fingerprint'], dtype=np.uint32), STRIDE)
+    db.executemany('insert into keys values (?, ?, ?)', zip(keys.tolist(), [track] * len(keys), pos.tolist()))
+
+
+def bit_errors(a, b, offset):
+    # bit error rate and overlap (in frames) with b shifted by offset frames against a
+    if offset < 0:
+        a, b, offset = b, a, -offset
+    a = a[offset:]
+    n = min(len(a), len(b))
+    if n == 0:
+        return 1.0, 0
+    return np.bitwise_count(a[:n] ^ b[:n]).sum() / (32 * n), n
+
+
+def candidates(db, track, prints):
+    # other tracks sharing enough LSH keys, with their votes per relative offset, best first
+    keys, pos = lsh_keys(prints)
+    db.execute('create temp table if not exists query (key integer, pos integer)')
+    db.execute('delete from query')
+    db.executemany('insert into query values (?, ?)', zip(keys.tolist(), pos.tolist()))
+    return db.execute('select k.track, k.pos - q.pos, count(*) as hits from query q join keys k on k.key = q.key'
+                      ' where k.track != ? and k.key not in (select key from keys where key in (select key from query)'
+                      f' group by key having count(distinct track) > {MAX_KEY_TRACKS})'
+                      ' group by k.track, k.pos - q.pos having hits >= ? order by hits desc',
+                      (track, MIN_HITS)).fetchall()
+
+
+def match(db, track, prints, fingerprints, ber=BER, min_overlap=MIN_OVERLAP):
+    # {other track: (ber, offset in frames)} for every verified near-duplicate of track
+    matches = {}
+    for other, offset, _ in candidates(db, track, prints):
+        if other in matches or other not in fingerprints:
+            continue
+        theirs = fingerprints[other]
+        # the stored frames line up within a hop either way, so check the neighbours of the voted offset
+        rate, shift = min((bit_errors(theirs, prints, o)[0], o) for o in (offset - 1, offset, offset + 1))
+        overlap = bit_errors(theirs, prints, shift)[1]
+        if rate < ber and overlap >= min_overlap * min(len(prints), len(theirs)):
+            matches[other] = (rate, shift)
+    return matches
+
+
+def clusters(pairs):
+    parent = {}
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = x = parent[parent[x]]
+        return x
+
+    for a, b in pairs:
+        parent[find(a)] = find(b)
+    groups = {}
+    for x in parent:
+        groups.setdefault(find(x), []).append(x)
+    return list(groups.values())
+
+
+def keeper_rank(track):
+    # lossless first, then bit depth, sample rate and bitrate; size breaks ties
+    return (track['codec'] == 'flac', track['bits'] or 0, track['rate'] or 0, track['kbps'] or 0, track['size'])
+
+
+def scan(db, paths, jobs):
+    sizes, stale = {}, []
+    known = {path: (size, mtime) for path, size, mtime in db.execute('select path, size, mtime from tracks')}
+    stats = {path: os.stat(path) for path in map(os.path.abspath, lufs.find_audio(paths))}
+    for path, st in stats.items():
+        if known.get(path) != (st.st_size, st.st_mtime_ns):
+            stale.append(path)
+            sizes[path] = st.st_size
+    for path in known:
+        if path not in stats and not os.path.exists(path):
+            db.execute('delete from keys where track in (select id from tracks where path = ?)', (path,))
+            db.execute('delete from tracks where path = ?', (path,))
+    db.commit()
+
+    stale.sort(key=sizes.get, reverse=True)
+    failed = 0
+    with multiprocessing.Pool(jobs, initializer=lufs.init_worker, initargs=(False,)) as pool, \
+            tqdm(total=sum(sizes.values()), unit='B', unit_scale=True, unit_divisor=1024, leave=False) as bar:
+        try:
+            for i, record in enumerate(pool.imap_unordered(run_task, stale), 1):
+                if 'error' in record:
+                    failed += 1
+                    tqdm.write(f'{record["path"]} | {record["error"]}', file=sys.stderr)
+                else:
+                    store(db, record, stats[record['path']])
+                    if i % 64 == 0:
+                        db.commit()
+                bar.set_postfix_str(f'{i}/{len(stale)} files', refresh=False)
+                bar.update(sizes[record['path']])
+        except KeyboardInterrupt:
+            pool.terminate()
+            bar.close()
+            db.commit()
+            print('Interrupted', file=sys.stderr)
+            sys.exit(130)
+    db.commit()
+    return list(stats), len(stale), failed
+
+
+def format_track(track, keeper=False):
+    quality = f'{track["bits"]}bit' if track['bits'] else track['codec']
+    line = f'{"*" if keeper else " "} {track["path"]} | {quality} {track["rate"] / 1000:.1f}KHz {track["kbps"]:.0f}kbps'
+    if 'ber' in track:
+        line += f' | BER {track["ber"]:.3f} offset {track["offset"]:+.2f}s'
+    return line
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('paths', nargs='*', default=['.'])
+    ap.add_argument('-j', '--jobs', type=int, default=max(1, multiprocessing.cpu_count() // 2))
+    ap.add_argument('--ber', type=float, default=BER, help='highest bit error rate still counted as the same audio')
+    ap.add_argument('--min-overlap', type=float, default=MIN_OVERLAP,
+                    help='fraction of the shorter track that has to line up')
+    ap.add_argument('-f', '--format', choices=('text', 'json'), default='text')
+    args = ap.parse_intermixed_args()
+
+    start = time.monotonic()
+    db = open_index()
+    paths, scanned, failed = scan(db, args.paths, args.jobs)
+
+    tracks, fingerprints = {}, {}
+    wanted = set(paths)
+    for row in db.execute('select id, path, size, codec, bits, rate, kbps, duration, fingerprint from tracks'):
+        track = dict(zip(('id', 'path', 'size', 'codec', 'bits', 'rate', 'kbps', 'duration'), row))
+        if track['path'] in wanted:
+            tracks[track['id']] = track
+            fingerprints[track['id']] = np.frombuffer(row[-1], dtype=np.uint32)
+
+    pairs, found = [], {}
+    for track, prints in fingerprints.items():
+        for other, (rate, shift) in match(db, track, prints, fingerprints, args.ber, args.min_overlap).items():
+            pairs.append((track, other))
+            found[track, other] = (rate, shift)
+            found.setdefault((other, track), (rate, -shift))
+
+    groups = sorted((sorted(group, key=lambda t: tracks[t]['path']) for group in clusters(pairs)),
+                    key=lambda group: tracks[group[0]]['path'])
+    for group in groups:
+        keeper = max(group, key=lambda t: keeper_rank(tracks[t]))
+        members = [tracks[keeper]]
+        for track in group:
+            if track != keeper:
+                rate, offset = found.get((keeper, track), (None, 0))
+                members.append(dict(tracks[track], **({} if rate is None else
+                                                      dict(ber=rate, offset=offset * HOP / RATE))))
+        if args.format == 'json':
+            print(json.dumps(dict(keeper=members[0]['path'], duplicates=[
+                {key: member.get(key) for key in ('path', 'ber', 'offset')} for member in members[1:]])))
+        else:
+            print(f'{len(group)} copies')
+            for i, member in enumerate(members):
+                print('  ' + format_track(member, keeper=i == 0))
+
+    print(f'{len(paths)} files, {scanned} fingerprinted, {len(groups)} duplicate clusters,'
+          f' {time.monotonic() - start:.1f}s' + (f', {failed} failed' if failed else ''), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
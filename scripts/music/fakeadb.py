@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# A stand-in for adb backed by a local directory, for running the sync scripts without a phone:
+#
+#   FAKEADB_ROOT=/tmp/phone ADB=./fakeadb.py ./sync.py
+#
+# The root plays the device's /, shell commands run there under FAKEADB_SHELL (bash by default, for
+# mksh-style brace globs). FAKEADB_LATENCY adds seconds per call and per shell round trip,
+# FAKEADB_BANDWIDTH caps file and stream transfers in bytes/s, FAKEADB_LOG gets one line per call.
+
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.environ.get('FAKEADB_ROOT', os.path.expanduser('~/.cache/fakeadb'))
+SHELL = os.environ.get('FAKEADB_SHELL') or shutil.which('bash') or 'sh'
+LATENCY = float(os.environ.get('FAKEADB_LATENCY', 0))
+BANDWIDTH = float(os.environ.get('FAKEADB_BANDWIDTH', 0))
+LOG = os.environ.get('FAKEADB_LOG')
+
+
+def device_path(path):
+    return os.path.join(ROOT, path.lstrip('/'))
+
+
+def throttle(nbytes):
+    if BANDWIDTH:
+        time.sleep(nbytes / BANDWIDTH)
+
+
+def pump(src, dst, delay=0.0):
+    # copies until EOF, paying bandwidth per block and latency per burst
+    while data := src.read1(1 << 16):
+        if delay:
+            time.sleep(delay)
+        throttle(len(data))
+        dst.write(data)
+        dst.flush()
+    dst.close()
+
+
+def copy(src, dst, keep_mtime):
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    shutil.copyfile(src, dst)
+    throttle(os.path.getsize(dst))
+    if keep_mtime:
+        st = os.stat(src)
+        os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    print(f'{src}: 1 file pushed/pulled.', file=sys.stderr)
+
+
+def transfer(args, push):
+    args = list(args)
+    keep_mtime = push  # adb push always sends the mtime, pull only with -a
+    while args and args[0].startswith('-'):
+        flag = args.pop(0)
+        if flag == '-a':
+            keep_mtime = True
+        elif flag == '-z':
+            args.pop(0)
+    *srcs, dst = args
+    for src in srcs:
+        if push:
+            copy(src, device_path(dst), keep_mtime)
+        else:
+            if not os.path.exists(device_path(src)):
+                print(f"adb: error: failed to stat remote object '{src}': No such file or directory", file=sys.stderr)
+                return 1
+            copy(device_path(src), dst, keep_mtime)
+    return 0
+
+
+def shell(args, stdin=True):
+    if args:
+        proc = subprocess.Popen([SHELL, '-c', ' '.join(args)], cwd=ROOT, stdin=subprocess.PIPE if stdin else None,
+                                stdout=subprocess.PIPE)
+        if stdin:
+            threading.Thread(target=pump, args=(sys.stdin.buffer, proc.stdin), daemon=True).start()
+        pump(proc.stdout, sys.stdout.buffer)
+        return proc.wait()
+    # a session: every round trip through the pipe costs the latency, split between the two directions
+    proc = subprocess.Popen([SHELL], cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    threading.Thread(target=pump, args=(sys.stdin.buffer, proc.stdin, LATENCY / 2), daemon=True).start()
+    pump(proc.stdout, sys.stdout.buffer, LATENCY / 2)
+    return proc.wait()
+
+
+def main():
+    args = sys.argv[1:]
+    if LOG:
+        with open(LOG, 'a', errors='surrogateescape') as f:
+            f.write(' '.join(args) + '\n')
+    while args and args[0] in ('-s', '-d', '-e'):
+        args = args[2:] if args[0] == '-s' else args[1:]
+    if not args:
+        sys.exit('usage: fakeadb.py shell|exec-out|exec-in|push|pull ...')
+    os.makedirs(ROOT, exist_ok=True)
+    time.sleep(LATENCY)
+    command, args = args[0], args[1:]
+    if command == 'shell':
+        sys.exit(shell(args, stdin=False) if args else shell(args))
+    if command == 'exec-out':
+        sys.exit(shell(args, stdin=False))
+    if command == 'exec-in':
+        sys.exit(shell(args))
+    if command in ('push', 'pull'):
+        sys.exit(transfer(args, command == 'push'))
+    if command in ('wait-for-device', 'tcpip', 'connect', 'start-server', 'kill-server'):
+        sys.exit(0)
+    sys.exit(f'fakeadb: {command} not supported')
+
+
+if __name__ == '__main__':
+    main()
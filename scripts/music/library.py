@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import mutagen
+import mutagen.id3
+import mutagen.mp4
+
+INDEX_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'library.sqlite')
+INDEX_VERSION = 2
+EXTENSIONS = ('.flac', '.mp3', '.opus', '.ogg', '.m4a', '.wav')
+FIELDS = ('codec', 'bits', 'rate', 'channels', 'duration', 'kbps', 'tags')
+
+# tag names are normalised to the Vorbis comment ones, uppercase
+ID3_NAMES = {'TIT2': 'TITLE', 'TPE1': 'ARTIST', 'TPE2': 'ALBUMARTIST', 'TALB': 'ALBUM', 'TRCK': 'TRACKNUMBER',
+             'TPOS': 'DISCNUMBER', 'TDRC': 'DATE', 'TCON': 'GENRE', 'TCOM': 'COMPOSER', 'COMM': 'COMMENT',
+             'USLT': 'LYRICS', 'APIC': 'COVER'}
+MP4_NAMES = {'\xa9nam': 'TITLE', '\xa9ART': 'ARTIST', 'aART': 'ALBUMARTIST', '\xa9alb': 'ALBUM', 'trkn': 'TRACKNUMBER',
+             'disk': 'DISCNUMBER', '\xa9day': 'DATE', '\xa9gen': 'GENRE', '\xa9wrt': 'COMPOSER', '\xa9cmt': 'COMMENT',
+             '\xa9lyr': 'LYRICS', 'covr': 'COVER'}
+LOSSLESS = ('flac', 'alac', 'wav')
+CODECS = {'FLAC': 'flac', 'MP3': 'mp3', 'OggOpus': 'opus', 'OggVorbis': 'vorbis', 'OggFLAC': 'flac', 'WAVE': 'wav'}
+
+_index = None
+
+
+def open_index():
+    global _index
+    if _index is None:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        _index = sqlite3.connect(INDEX_PATH, timeout=60)
+        if _index.execute('pragma user_version').fetchone()[0] != INDEX_VERSION:
+            _index.execute('drop table if exists files')
+            _index.execute(f'pragma user_version = {INDEX_VERSION}')
+        # raw and rawdir are the bytes (os.fsencode) and what rows are matched by, so any file name can be
+        # stored; path and dir are the same as UTF-8 text, with undecodable bytes replaced, for --where
+        _index.execute('create table if not exists files (raw blob primary key, rawdir blob, path text, dir text,'
+                       ' ext text, size integer, mtime integer, codec text, bits integer, rate integer,'
+                       ' channels integer, duration real, kbps real, tags text)')
+        _index.execute('create index if not exists files_rawdir on files (rawdir)')
+    return _index
+
+
+def read_tags(audio):
+    tags = {}
+    if isinstance(audio.tags, mutagen.id3.ID3):
+        for frame in audio.tags.values():
+            if frame.FrameID == 'TXXX':
+                key = frame.desc.upper()
+            elif frame.FrameID in ID3_NAMES or frame.FrameID.startswith('T'):
+                key = ID3_NAMES.get(frame.FrameID, frame.FrameID)
+            else:
+                continue
+            text = frame.mime if frame.FrameID == 'APIC' else str(frame)
+            tags.setdefault(key, []).append(text)
+    elif isinstance(audio.tags, mutagen.mp4.MP4Tags):
+        for key, values in audio.tags.items():
+            if key.startswith('----:'):
+                key, values = key.rsplit(':', 1)[1].upper(), [bytes(value).decode(errors='replace') for value in values]
+            else:
+                key = MP4_NAMES.get(key, key)
+            tags[key] = ['/'.join(map(str, value)) if isinstance(value, tuple) else
+                         'image' if key == 'COVER' else str(value) for value in values]
+    elif audio.tags is not None:
+        # Vorbis comments: FLAC, Ogg
+        for key, value in audio.tags:
+            tags.setdefault(key.upper(), []).append(value)
+    if getattr(audio, 'pictures', None):
+        tags.setdefault('COVER', []).extend(picture.mime for picture in audio.pictures)
+    return {key: '; '.join(values) for key, values in tags.items()}
+
+
+def read_file(path):
+    # header and tags only, nothing is decoded
+    audio = mutagen.File(path)
+    if audio is None:
+        return dict.fromkeys(FIELDS)
+    info = audio.info
+    codec = CODECS.get(type(audio).__name__, type(audio).__name__.lower())
+    if isinstance(audio, mutagen.mp4.MP4):
+        codec = 'alac' if getattr(info, 'codec', '') == 'alac' else 'aac'
+    # mutagen reports a nominal bit depth for lossy MP4 too; opus always decodes at 48kHz
+    return dict(codec=codec, bits=getattr(info, 'bits_per_sample', None) if codec in LOSSLESS else None,
+                rate=getattr(info, 'sample_rate', 48000 if codec == 'opus' else None), channels=getattr(info, 'channels', None),
+                duration=info.length, kbps=(getattr(info, 'bitrate', 0) or 0) / 1000 or None,
+                tags=json.dumps(read_tags(audio), ensure_ascii=False, sort_keys=True))
+
+
+def walk(path, recursive=True):
+    # DirEntry of every audio file below path, in name order
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if recursive:
+                yield from walk(entry.path, recursive)
+        elif entry.name.lower().endswith(EXTENSIONS) and entry.is_file():
+            yield entry
+
+
+def under(root, recursive=True):
+    # SQL condition and parameters for the rows a scan of root covers
+    if os.path.isfile(root):
+        return 'raw = ?', (os.fsencode(root),)
+    if not recursive:
+        return 'rawdir = ?', (os.fsencode(root),)
+    prefix = os.fsencode(root.rstrip('/') + '/')
+    return 'substr(raw, 1, ?) = ?', (len(prefix), prefix)
+
+
+def covering(paths, recursive=True):
+    conditions, params = [], []
+    for root in map(os.path.abspath, paths):
+        condition, args = under(root, recursive)
+        conditions.append(condition)
+        params.extend(args)
+    return '(' + ' or '.join(conditions) + ')', params
+
+
+def scan(paths, recursive=True, db=None, verbose=False):
+    # brings the index up to date for paths: only new files or those whose size or mtime moved are
+    # opened again, files that are gone are dropped; returns (files seen, files read, removed, failed)
+    db = db or open_index()
+    seen = read = removed = failed = 0
+    with db:
+        for root in map(os.path.abspath, paths):
+            where, params = under(root, recursive)
+            known = {os.fsdecode(raw): (size, mtime) for raw, size, mtime in
+                     db.execute(f'select raw, size, mtime from files where {where}', params)}
+            if os.path.isfile(root):
+                entries = [(root, os.stat(root))]
+            else:
+                entries = ((entry.path, entry.stat()) for entry in walk(root, recursive))
+            for path, st in entries:
+                seen += 1
+                if known.pop(path, None) == (st.st_size, st.st_mtime_ns):
+                    continue
+                try:
+                    info = read_file(path)
+                    raw, rawdir = os.fsencode(path), os.fsencode(os.path.dirname(path))
+                    db.execute('insert or replace into files (raw, rawdir, path, dir, ext, size, mtime,'
+                               f' {", ".join(FIELDS)}) values (?, ?, ?, ?, ?, ?, ?, {", ".join("?" * len(FIELDS))})',
+                               (raw, rawdir, raw.decode(errors='replace'), rawdir.decode(errors='replace'),
+                                os.path.splitext(path)[1].lower(), st.st_size, st.st_mtime_ns,
+                                *[info[key] for key in FIELDS]))
+                except (mutagen.MutagenError, OSError) as e:
+                    failed += 1
+                    print(f'{path} | {type(e).__name__}: {e}', file=sys.stderr)
+                    continue
+                read += 1
+                if verbose:
+                    print('Read', path, file=sys.stderr)
+            for path in known:
+                db.execute('delete from files where raw = ?', (os.fsencode(path),))
+                removed += 1
+    return seen, read, removed, failed
+
+
+def select(where=None, paths=('.',), recursive=True, extensions=None, db=None):
+    # paths below paths matching the SQL condition where, after an incremental scan; a condition
+    # SQLite can't compile raises ValueError before anything is scanned
+    db = db or open_index()
+    if where:
+        try:
+            db.execute(f'explain select raw from files where ({where})')
+        except sqlite3.Error as e:
+            raise ValueError(f'bad --where {where!r}: {e}') from None
+    scan(paths, recursive, db)
+    condition, params = covering(paths, recursive)
+    sql = 'select raw from files where ' + condition
+    if extensions:
+        sql += f' and ext in ({", ".join("?" * len(extensions))})'
+        params.extend(extensions)
+    if where:
+        sql += f' and ({where})'
+    return [os.fsdecode(raw) for raw, in db.execute(sql + ' order by raw', params)]
+
+
+def format_row(row):
+    quality = f'{row["bits"]}bit' if row['bits'] else row['codec'] or row['ext'][1:]
+    duration = row['duration'] or 0
+    return (f'{os.fsdecode(row["raw"])} | {quality} {(row["rate"] or 0) / 1000:.1f}KHz {row["kbps"] or 0:.0f}kbps'
+            f' | {int(duration // 60)}:{int(duration % 60):02d}')
+
+
+def main():
+    ap = argparse.ArgumentParser(description='all conditions have to hold')
+    ap.add_argument('paths', nargs='*', default=['.'])
+    ap.add_argument('-w', '--where', help="SQL over path, dir, ext, size, mtime, codec, bits, rate, channels,"
+                                          " duration, kbps and tags (JSON), e.g. \"tags ->> 'ARTIST' like '%%Queen%%'\"")
+    ap.add_argument('-c', '--codec', action='append', help='codec is one of these')
+    ap.add_argument('-m', '--missing', action='append', default=[], metavar='TAG', help='tag is not set')
+    ap.add_argument('-t', '--has', action='append', default=[], metavar='TAG', help='tag is set')
+    ap.add_argument('--longer', type=float, metavar='MIN', help='longer than this many minutes')
+    ap.add_argument('--shorter', type=float, metavar='MIN', help='shorter than this many minutes')
+    ap.add_argument('-f', '--format', choices=('text', 'paths', 'json'), default='text')
+    ap.add_argument('-0', '--null', action='store_true', help='NUL-terminate paths')
+    ap.add_argument('-n', '--no-scan', action='store_true', help='query the index as it is')
+    ap.add_argument('-v', '--verbose', action='store_true')
+    args = ap.parse_intermixed_args()
+
+    condition, params = covering(args.paths)
+    conditions = [condition]
+    if args.codec:
+        conditions.append(f'codec in ({", ".join("?" * len(args.codec))})')
+        params.extend(args.codec)
+    for tag in args.missing:
+        conditions.append('tags ->> ? is null')
+        params.append(f'$."{tag.upper()}"')
+    for tag in args.has:
+        conditions.append('tags ->> ? is not null')
+        params.append(f'$."{tag.upper()}"')
+    if args.longer is not None:
+        conditions.append('duration > ?')
+        params.append(args.longer * 60)
+    if args.shorter is not None:
+        conditions.append('duration < ?')
+        params.append(args.shorter * 60)
+    if args.where:
+        conditions.append(f'({args.where})')
+    sql = 'select * from files where ' + ' and '.join(conditions) + ' order by raw'
+
+    start = time.monotonic()
+    db = open_index()
+    try:
+        db.execute('explain ' + sql, params)
+    except sqlite3.Error as e:
+        ap.error(f'bad --where: {e}')
+    if not args.no_scan:
+        seen, read, removed, failed = scan(args.paths, db=db, verbose=args.verbose)
+        print(f'{seen} files, {read} read, {removed} removed, {time.monotonic() - start:.1f}s'
+              + (f', {failed} failed' if failed else ''), file=sys.stderr)
+
+    db.row_factory = sqlite3.Row
+    rows = db.execute(sql, params).fetchall()
+    sys.stdout.reconfigure(errors='surrogateescape')
+    for row in rows:
+        if args.format == 'json':
+            record = {key: row[key] for key in row.keys() if key not in ('raw', 'rawdir')}
+            print(json.dumps(dict(record, path=os.fsdecode(row['raw']), dir=os.fsdecode(row['rawdir']),
+                                  tags=json.loads(row['tags'] or '{}')), ensure_ascii=False))
+        elif args.format == 'paths' or args.null:
+            print(os.fsdecode(row['raw']), end='\0' if args.null else '\n')
+        else:
+            print(format_row(row))
+    print(f'{len(rows)} matching', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,84 +1,513 @@
 #!/usr/bin/python
 
-import glob
+import argparse
+import collections
+import csv
+import functools
+import hashlib
+import io
+import json
 import pyloudnorm
 import multiprocessing
 import numpy as np
 import mutagen.flac
+import mutagen.id3
 import mutagen.mp3
-import pydub
+import scipy.signal
+import signal
+import sqlite3
+import sys
 import os
+import time
+from tqdm import tqdm
+
+import decode
+import library
+
+
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'lufs.sqlite')
+CACHE_VERSION = 4
+CHUNK_FRAMES = 1 << 16
+EXTENSIONS = ('.flac', '.mp3')
+FIELDS = ('lufs', 'peak', 'true_peak', 'rate', 'bits', 'duration', 'blocks')
+
+# BS.1770-4 annex 2: 4x oversampling polyphase FIR, one row per phase
+TRUE_PEAK_PHASES = np.array([
+    [0.0017089843750, 0.0109863281250, -0.0196533203125, 0.0332031250000, -0.0594482421875, 0.1373291015625,
+     0.9721679687500, -0.1022949218750, 0.0476074218750, -0.0266113281250, 0.0148925781250, -0.0083007812500],
+    [-0.0291748046875, 0.0292968750000, -0.0517578125000, 0.0891113281250, -0.1665039062500, 0.4650878906250,
+     0.7797851562500, -0.2003173828125, 0.1015625000000, -0.0582275390625, 0.0330810546875, -0.0189208984375],
+    [-0.0189208984375, 0.0330810546875, -0.0582275390625, 0.1015625000000, -0.2003173828125, 0.7797851562500,
+     0.4650878906250, -0.1665039062500, 0.0891113281250, -0.0517578125000, 0.0292968750000, -0.0291748046875],
+    [-0.0083007812500, 0.0148925781250, -0.0266113281250, 0.0476074218750, -0.1022949218750, 0.9721679687500,
+     0.1373291015625, -0.0594482421875, 0.0332031250000, -0.0196533203125, 0.0109863281250, 0.0017089843750],
+])
+
+rehash = False
 
 
 def show_audio(path):
-    segment: pydub.AudioSegment = pydub.AudioSegment.from_file(path)
+    audio = mutagen.File(path)
+    info = audio.info if audio is not None else None
     size = os.stat(path).st_size
-    duration = segment.frame_count() / segment.frame_rate
-    print(f'{path} | {segment.sample_width * 8}bit {segment.frame_rate / 1000:.1f}KHz {size / duration / 1000:.0f}kbps')
+    if info is None or info.length <= 0 or info.sample_rate <= 0 or getattr(info, 'sketchy', False) \
+            or getattr(info, 'total_samples', 1) == 0 or size * 8 / info.length < info.bitrate / 2:
+        return decode_audio_info(path, size)
+    codec = 'flac' if isinstance(info, mutagen.flac.StreamInfo) else 'mp3' if isinstance(info, mutagen.mp3.MPEGInfo) \
+        else type(audio).__name__.lower()
+    return dict(path=path, codec=codec, bits=getattr(info, 'bits_per_sample', None), rate=info.sample_rate,
+                channels=info.channels, duration=info.length, kbps=info.bitrate / 1000, source='header')
+
+
+def decode_audio_info(path, size):
+    with decode.open_audio(path) as decoder:
+        frames = sum(len(chunk) for chunk in decoder)
+    duration = frames / decoder.rate
+    return dict(path=path, codec=os.path.splitext(path)[1][1:].lower(), bits=decoder.bits, rate=decoder.rate,
+                channels=decoder.channels, duration=duration, kbps=size * 8 / duration / 1000, source='decode')
 
 
 def read_audio(path):
-    segment: pydub.AudioSegment = pydub.AudioSegment.from_file(path)
-    audio = np.array(segment.get_array_of_samples())
-    audio = audio.astype(np.float64) / (1 << (segment.sample_width * 8 - 1))
-    rate = segment.frame_rate
-    return audio, rate
+    with decode.open_audio(path) as decoder:
+        return decoder.read(), decoder.rate
 
 
 def calculate_lufs(audio, rate):
-    meter = pyloudnorm.Meter(rate)
-    loudness = meter.integrated_loudness(audio)
-    return loudness
+    audio = audio.reshape(len(audio), -1)
+    meter = LoudnessMeter(rate, audio.shape[1])
+    for i in range(0, len(audio), CHUNK_FRAMES):
+        meter.feed(audio[i:i + CHUNK_FRAMES])
+    return meter.integrated()
 
 
 def calculate_peak(audio):
-    return max(audio.max(), -audio.min())
+    audio = audio.reshape(len(audio), -1)
+    return float(np.maximum(audio.max(axis=0), -audio.min(axis=0)).max())
+
+
+class LoudnessMeter:
+    # BS.1770 integrated loudness over a stream of (frames, channels) blocks: only the
+    # channel-weighted energy of every 100 ms step is kept, the 400 ms gating blocks are
+    # assembled from four consecutive steps when the measurement is finished.
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.filters = [(f.passband_gain * f.b, f.a) for f in pyloudnorm.Meter(rate)._filters.values()]
+        self.state = [np.zeros((max(len(b), len(a)) - 1, channels)) for b, a in self.filters]
+        if channels > 6:
+            raise ValueError(f'no BS.1770 channel weights for {channels} channels')
+        # L R C Ls Rs as pyloudnorm orders them; 5.1 comes as FL FR FC LFE BL BR and LFE doesn't count
+        self.weights = np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41] if channels == 6 else
+                                [1.0, 1.0, 1.0, 1.41, 1.41][:channels])
+        self.steps = []
+        self.partial = 0.0
+        self.frames = 0
+
+    def feed(self, block):
+        for i, (b, a) in enumerate(self.filters):
+            block, self.state[i] = scipy.signal.lfilter(b, a, block, axis=0, zi=self.state[i])
+        energy = np.square(block) @ self.weights
+        start, self.frames = self.frames, self.frames + len(energy)
+        pos = 0
+        while (edge := (len(self.steps) + 1) * self.rate // 10 - start) <= len(energy):
+            self.steps.append(self.partial + energy[pos:edge].sum())
+            self.partial = 0.0
+            pos = edge
+        self.partial += energy[pos:].sum()
+
+    def blocks(self):
+        count = int(np.round((self.frames / self.rate - 0.4) / 0.1)) + 1
+        if count <= 0:
+            return np.empty(0)
+        steps = np.zeros(count + 3)
+        done = np.array(self.steps[:count + 3])
+        steps[:len(done)] = done
+        if len(done) < len(steps):
+            steps[len(done)] = self.partial
+        return (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]) / (0.4 * self.rate)
+
+    def integrated(self):
+        if self.frames < 0.4 * self.rate:
+            return None
+        return gated_loudness(self.blocks())
+
+
+def gated_loudness(blocks):
+    with np.errstate(divide='ignore'):
+        loudness = -0.691 + 10 * np.log10(blocks)
+        blocks, loudness = blocks[loudness >= -70], loudness[loudness >= -70]
+        if len(blocks) == 0:
+            return float('-inf')
+        relative = -0.691 + 10 * np.log10(blocks.mean()) - 10
+        blocks = blocks[loudness > relative]
+        if len(blocks) == 0:
+            return float('-inf')
+        return -0.691 + 10 * np.log10(blocks.mean())
+
+
+class TruePeakMeter:
+    # each phase of the oversampler is a 12-tap FIR run over all channels at once,
+    # with the filter state carried between blocks
+
+    def __init__(self, channels):
+        self.state = np.zeros((len(TRUE_PEAK_PHASES), TRUE_PEAK_PHASES.shape[1] - 1, channels))
+        self.peak = 0.0
+
+    def feed(self, block):
+        for i, taps in enumerate(TRUE_PEAK_PHASES):
+            oversampled, self.state[i] = scipy.signal.lfilter(taps, [1.0], block, axis=0, zi=self.state[i])
+            self.peak = max(self.peak, calculate_peak(oversampled))
+
+
+def measure(path):
+    with decode.open_audio(path) as decoder:
+        meter = LoudnessMeter(decoder.rate, decoder.channels)
+        true_peak = TruePeakMeter(decoder.channels)
+        peak = 0.0
+        for chunk in decoder.chunks(CHUNK_FRAMES):
+            meter.feed(chunk)
+            true_peak.feed(chunk)
+            peak = max(peak, calculate_peak(chunk))
+    return dict(lufs=meter.integrated(), peak=peak, true_peak=max(peak, true_peak.peak), rate=decoder.rate,
+                bits=decoder.bits, duration=meter.frames / decoder.rate, blocks=meter.blocks())
+
+
+_cache = None
+
+def open_cache():
+    global _cache
+    if _cache is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _cache = sqlite3.connect(CACHE_PATH, timeout=60)
+        if _cache.execute('pragma user_version').fetchone()[0] != CACHE_VERSION:
+            _cache.execute('drop table if exists lufs')
+            _cache.execute(f'pragma user_version = {CACHE_VERSION}')
+        # paths are keyed as their bytes, so names that aren't valid UTF-8 are cached too
+        _cache.execute('create table if not exists lufs (path blob primary key, size integer, mtime integer,'
+                       ' hash text, lufs real, peak real, true_peak real, rate integer, bits integer, duration real, blocks blob)')
+    return _cache
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def analyze(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    digest = file_hash(path) if rehash else None
+    db = open_cache()
+    cache_key = os.fsencode(path)
+    row = db.execute(f'select size, mtime, hash, {", ".join(FIELDS)} from lufs where path = ?',
+                     (cache_key,)).fetchone()
+    if row is not None and row[0] == st.st_size and (row[2] == digest if rehash else row[1] == st.st_mtime_ns):
+        info = dict(zip(FIELDS, row[3:]))
+        info['blocks'] = np.frombuffer(info['blocks'], np.float32).astype(np.float64)
+        return info
+
+    info = measure(path)
+    with db:
+        db.execute(f'insert or replace into lufs (path, size, mtime, hash, {", ".join(FIELDS)})'
+                   f' values (?, ?, ?, ?, {", ".join("?" * len(FIELDS))})',
+                   (cache_key, st.st_size, st.st_mtime_ns, digest, *[info[key] for key in FIELDS[:-1]],
+                    info['blocks'].astype(np.float32).tobytes()))
+    return info
+
+
+def retag_cache(path):
+    # tag edits leave the audio alone, so carry the cached analysis over to the new stat
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    db = open_cache()
+    with db:
+        db.execute('update lufs set size = ?, mtime = ?, hash = null where path = ?',
+                   (st.st_size, st.st_mtime_ns, os.fsencode(path)))
+
+
+def album_key(path, mode):
+    if mode == 'tag':
+        tags = mutagen.File(path, easy=True)
+        album = tags and tags.get('album')
+        if album:
+            return album[0]
+    return os.path.dirname(os.path.abspath(path))
 
 
 def show_lufs(path):
-    audio, rate = read_audio(path)
-    lufs = calculate_lufs(audio, rate)
-    if lufs is None:
-        lufs = 0
-    peak = calculate_peak(audio)
-    print(f'{path} | LUFS {lufs:+.2f} dB | Peak {peak:.6f}')
-    return lufs
-
-
-def apply_lufs(path, target=-20):
-    audio, rate = read_audio(path)
-    lufs = calculate_lufs(audio, rate)
-    if lufs is None:
-        lufs = target
-    peak = calculate_peak(audio)
-    print(f'{path} | LUFS {lufs:+.2f} dB | Peak {peak:.6f}')
-    gain = target - lufs
-    set_replaygain(path, gain, peak)
-    return lufs
-
-
-def set_replaygain(path, gain, peak):
+    info = analyze(path)
+    del info['blocks']
+    if info['lufs'] is None:
+        info['lufs'] = 0
+    return dict(path=path, **info)
+
+
+def analyze_album_track(path, album):
+    return dict(path=path, album=album_key(path, album), **analyze(path))
+
+
+def clamp_gain(gain, true_peak, ceiling):
+    # keep gain + true peak at or below the ceiling (dBTP), as a limiter would
+    if ceiling is None or true_peak <= 0:
+        return gain
+    return min(gain, ceiling - 20 * np.log10(true_peak))
+
+
+def apply_lufs(path, target=-20, dry_run=False, true_peak=False, ceiling=None):
+    info = analyze(path)
+    del info['blocks']
+    if info['lufs'] is None:
+        info['lufs'] = target
+    # digital silence measures -inf, which would be an infinite gain
+    loudness = info['lufs'] if np.isfinite(info['lufs']) else target
+    gain = clamp_gain(target - loudness, info['true_peak'], ceiling)
+    status, changes = set_replaygain(path, gain, info['true_peak' if true_peak else 'peak'], dry_run=dry_run)
+    return dict(path=path, gain=gain, status=status, changes=changes, **info)
+
+
+class DryRun(Exception):
+    pass
+
+
+def tag_matches(old, new):
+    number = new.split()[0]
+    try:
+        return f'{float(old.split()[0]):.{len(number.partition(".")[2])}f}' == number
+    except (AttributeError, IndexError, ValueError):
+        return False
+
+
+def set_replaygain(path, gain, peak, album_gain=None, album_peak=None, dry_run=False):
+    values = {'REPLAYGAIN_TRACK_GAIN': f'{gain:.2f} dB', 'REPLAYGAIN_TRACK_PEAK': f'{peak:.6f}'}
+    if album_gain is not None:
+        values.update({'REPLAYGAIN_ALBUM_GAIN': f'{album_gain:.2f} dB', 'REPLAYGAIN_ALBUM_PEAK': f'{album_peak:.6f}'})
+
     if path.endswith('.flac'):
         audio = mutagen.flac.FLAC(path)
-        audio["REPLAYGAIN_TRACK_GAIN"] = f"{gain:.2f} dB"
-        audio["REPLAYGAIN_TRACK_PEAK"] = f"{peak:.6f}"
-        audio.save()
+        old = {key: audio.get(key, [None])[0] for key in values}
     elif path.endswith('.mp3'):
         audio = mutagen.mp3.Open(path)
-        audio["TXXX:REPLAYGAIN_TRACK_GAIN"] = f"{gain:.2f} dB"
-        audio["TXXX:REPLAYGAIN_TRACK_PEAK"] = f"{peak:.6f}"
-        audio.save()
+        if audio.tags is None:
+            audio.add_tags()
+        frames = {frame.desc.upper(): frame for frame in audio.tags.getall('TXXX')}
+        old = {key: frames[key].text[0] if key in frames else None for key in values}
+    else:
+        return 'unsupported', {}
+
+    changes = {key: (old[key], value) for key, value in values.items() if not tag_matches(old[key], value)}
+    if not changes:
+        return 'unchanged', changes
+
+    if path.endswith('.flac'):
+        for key, value in values.items():
+            audio[key] = value
+        kwargs = {}
+    else:
+        for key, value in values.items():
+            if key in frames:
+                audio.tags.delall(f'TXXX:{frames[key].desc}')
+            audio.tags.add(mutagen.id3.TXXX(encoding=3, desc=key, text=[value]))
+        kwargs = {'v2_version': audio.tags.version[1] if audio.tags.version[1] in (3, 4) else 4}
+        if kwargs['v2_version'] == 3:
+            audio.tags.update_to_v23()
+
+    fits = True
+
+    def padding(info):
+        # keep whatever padding is left so the tags are rewritten in place; only when
+        # they outgrow it does the file get rewritten, with some room for next time
+        nonlocal fits
+        fits = info.padding >= 0
+        if dry_run:
+            raise DryRun
+        return info.padding if fits else max(info.get_default_padding(), 16 << 10)
+
+    try:
+        audio.save(padding=padding, **kwargs)
+    except DryRun:
+        pass
+    else:
+        retag_cache(path)
+    return 'updated' if fits else 'rewritten', changes
+
+
+def apply_album(records, target=-20, write=True, dry_run=False, true_peak=False, ceiling=None):
+    albums = {}
+    for record in records:
+        albums.setdefault(record['album'], []).append(record)
+    peak_key = 'true_peak' if true_peak else 'peak'
+    for album, tracks in sorted(albums.items()):
+        lufs = gated_loudness(np.concatenate([track['blocks'] for track in tracks]))
+        if not np.isfinite(lufs):
+            lufs = target
+        peak = max(track[peak_key] for track in tracks)
+        album_gain = clamp_gain(target - lufs, max(track['true_peak'] for track in tracks), ceiling)
+        if write:
+            for track in tracks:
+                loudness = track['lufs'] if track['lufs'] is not None and np.isfinite(track['lufs']) else target
+                gain = target - loudness
+                gain = clamp_gain(gain, track['true_peak'], ceiling)
+                try:
+                    track['status'], track['changes'] = set_replaygain(
+                        track['path'], gain, track[peak_key], album_gain, peak, dry_run=dry_run)
+                except Exception as e:
+                    track['status'], track['changes'] = f'{type(e).__name__}: {e}', {}
+        yield dict(album=album, tracks=tracks, lufs=lufs, peak=peak, gain=album_gain)
+
+
+def format_changes(record):
+    return ''.join(f'\n    {key}: {old} -> {new}' for key, (old, new) in record['changes'].items())
 
 
 def show_replaygain(path):
     if path.endswith('.flac'):
         audio = mutagen.flac.FLAC(path)
-        print(f'{path} | Gain {audio["REPLAYGAIN_TRACK_GAIN"]} Peak {audio["REPLAYGAIN_TRACK_PEAK"]}')
+        return dict(path=path, gain=audio["REPLAYGAIN_TRACK_GAIN"], peak=audio["REPLAYGAIN_TRACK_PEAK"])
     elif path.endswith('.mp3'):
         audio = mutagen.mp3.Open(path)
-        print(f'{path} | Gain {audio["TXXX:REPLAYGAIN_TRACK_GAIN"]} Peak {audio["TXXX:REPLAYGAIN_TRACK_PEAK"]}')
+        return dict(path=path, gain=audio["TXXX:REPLAYGAIN_TRACK_GAIN"], peak=audio["TXXX:REPLAYGAIN_TRACK_PEAK"])
+    return dict(path=path, error='unsupported, only .flac and .mp3 are tagged')
+
+
+COMMANDS = {
+    'show': (show_lufs, lambda r: f'{r["path"]} | LUFS {r["lufs"]:+.2f} dB | Peak {r["peak"]:.6f}'
+                                  f' | True peak {r["true_peak"]:.6f}'),
+    'apply': (apply_lufs, lambda r: f'{r["path"]} | LUFS {r["lufs"]:+.2f} dB | Peak {r["peak"]:.6f}'
+                                    f' | True peak {r["true_peak"]:.6f} | Gain {r["gain"]:+.2f} dB | {r["status"]}'
+                                    + format_changes(r)),
+    'replaygain': (show_replaygain, lambda r: f'{r["path"]} | Gain {r["gain"]} Peak {r["peak"]}'),
+    'audio-info': (show_audio, lambda r: f'{r["path"]} | {str(r["bits"]) + "bit" if r["bits"] else r["codec"]}'
+                                         f' {r["rate"] / 1000:.1f}KHz {r["kbps"]:.0f}kbps'),
+}
+
+
+def csv_formatter():
+    header = []
+
+    def format(record):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, header or list(record), extrasaction='ignore', lineterminator='\n')
+        if not header:
+            header.extend(record)
+            writer.writeheader()
+        writer.writerow(record)
+        return out.getvalue().rstrip('\n')
+
+    return format
+
+
+def find_audio(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def init_worker(rehash_):
+    global rehash
+    rehash = rehash_
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_task(func, path):
+    try:
+        return func(path)
+    except Exception as e:
+        return dict(path=path, error=f'{type(e).__name__}: {e}')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('command', choices=COMMANDS)
+    ap.add_argument('paths', nargs='*', default=['.'])
+    ap.add_argument('-j', '--jobs', type=int, default=max(1, multiprocessing.cpu_count() // 2))
+    ap.add_argument('-t', '--target', type=float, default=-20)
+    ap.add_argument('-a', '--album', choices=('dir', 'tag'))
+    ap.add_argument('-n', '--dry-run', action='store_true')
+    ap.add_argument('-T', '--true-peak', action='store_true', help='write true peak instead of sample peak')
+    ap.add_argument('-c', '--ceiling', type=float, help='limit gain so the true peak stays below this dBTP')
+    ap.add_argument('-f', '--format', choices=('text', 'csv', 'json'), default='text')
+    ap.add_argument('--rehash', action='store_true')
+    ap.add_argument('-w', '--where', help='only files the library index matches, see library.py')
+    args = ap.parse_intermixed_args()
+
+    func, fmt = COMMANDS[args.command]
+    if args.album:
+        if args.command not in ('show', 'apply'):
+            ap.error('--album only applies to show and apply')
+        func = functools.partial(analyze_album_track, album=args.album)
+        # apply_album wants the None of a track too short to measure, the line shows it as 0 like show_lufs
+        show = COMMANDS['show'][1]
+        fmt = lambda record: show(dict(record, lufs=0 if record['lufs'] is None else record['lufs']))
+    elif args.command == 'apply':
+        func = functools.partial(func, target=args.target, dry_run=args.dry_run, true_peak=args.true_peak,
+                                 ceiling=args.ceiling)
+    if args.format == 'json':
+        fmt = functools.partial(json.dumps, default=str)
+    elif args.format == 'csv':
+        fmt = csv_formatter()
+
+    try:
+        found = library.select(args.where, args.paths, extensions=EXTENSIONS) if args.where else find_audio(args.paths)
+    except ValueError as e:
+        ap.error(str(e))
+    sizes, failed = {}, 0
+    for path in found:
+        try:
+            sizes[path] = os.stat(path).st_size
+        except OSError as e:
+            failed += 1
+            print(f'{path} | {type(e).__name__}: {e.strerror}', file=sys.stderr)
+    paths = sorted(sizes, key=sizes.get, reverse=True)
+    start = time.monotonic()
+    records = []
+    statuses = collections.Counter()
+    with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args.rehash,)) as pool, \
+            tqdm(total=sum(sizes.values()), unit='B', unit_scale=True, unit_divisor=1024, leave=False) as bar:
+        try:
+            for i, record in enumerate(pool.imap_unordered(functools.partial(run_task, func), paths), 1):
+                if 'error' in record:
+                    failed += 1
+                    tqdm.write(f'{record["path"]} | {record["error"]}', file=sys.stderr)
+                else:
+                    tqdm.write(fmt({key: value for key, value in record.items() if key != 'blocks'}))
+                    if 'status' in record:
+                        statuses[record['status']] += 1
+                    if args.album:
+                        records.append(record)
+                bar.set_postfix_str(f'{i}/{len(paths)} files', refresh=False)
+                bar.update(sizes[record['path']])
+        except KeyboardInterrupt:
+            pool.terminate()
+            bar.close()
+            print('Interrupted', file=sys.stderr)
+            sys.exit(130)
+
+    for album in apply_album(records, args.target, write=args.command == 'apply', dry_run=args.dry_run,
+                             true_peak=args.true_peak, ceiling=args.ceiling):
+        out = sys.stdout if args.format == 'text' else sys.stderr
+        print(f'{album["album"]} | {len(album["tracks"])} tracks | LUFS {album["lufs"]:+.2f} dB'
+              f' | Peak {album["peak"]:.6f} | Gain {album["gain"]:+.2f} dB', file=out)
+        for track in album['tracks']:
+            if 'status' in track:
+                statuses[track['status']] += 1
+                if track['status'] != 'unchanged':
+                    print(f'  {track["path"]} | {track["status"]}' + format_changes(track), file=out)
+
+    elapsed = max(time.monotonic() - start, 1e-6)
+    print(f'{len(paths)} files, {sum(sizes.values()) / elapsed / 1e6:.1f} MB/s, {elapsed:.1f}s'
+          + (f', {failed} failed' if failed else '')
+          + ''.join(f', {count} {status}' for status, count in sorted(statuses.items())), file=sys.stderr)
+    sys.exit(1 if failed else 0)
 
 
-pool = multiprocessing.Pool(multiprocessing.cpu_count() // 2)
-paths = glob.glob('*.flac') + glob.glob('*.mp3')
-pool.map(show_lufs, paths)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+
+import adbshell
+
+LOCAL_PATH = '.sync-manifest.json'
+REMOTE_PATH = 'storage/emulated/0/.sync-manifest.json'
+ZERO_MD5 = '0' * 32
+HASH_VERSION = 2  # bump when audio_hash() changes, so hashes remembered under the old scheme are redone
+
+# md5 of nothing: what every MP3 without audio frames hashes to, so it says nothing about which song it is
+EMPTY_HASHES = {'mp3:d41d8cd98f00b204e9800998ecf8427e', 'md5:d41d8cd98f00b204e9800998ecf8427e'}
+
+# the same hash computed on the device with toybox od/head/tail/md5sum; must stay byte-for-byte
+# equivalent to audio_hash() below
+REMOTE_SCRIPT = r'''
+for f; do
+    set -- $(od -An -tu1 -N10 "$f")
+    start=0
+    if [ $# -ge 10 ] && [ "$1 $2 $3" = "73 68 51" ]; then
+        start=$((10 + ($7 << 21 | $8 << 14 | $9 << 7 | ${10})))
+        [ $(($6 & 16)) = 0 ] || start=$((start + 10))
+    fi
+    case "$f" in
+    *.flac|*.FLAC)
+        m=
+        if [ "$(od -An -tx1 -j$start -N4 "$f" | tr -d ' \n')" = 664c6143 ]; then
+            m=$(od -An -tx1 -j$((start + 26)) -N16 "$f" | tr -d ' \n')
+        fi
+        if [ ${#m} != 32 ] || [ "$m" = %(zero)s ]; then
+            m=md5:$(md5sum < "$f" | cut -d' ' -f1)
+        else
+            m=flac:$m
+        fi ;;
+    *)
+        end=$(stat -c %%s "$f")
+        [ "$(tail -c 128 "$f" | head -c 3)" = TAG ] && end=$((end - 128))
+        m=mp3:$(tail -c +$((start + 1)) "$f" | head -c $((end > start ? end - start : 0)) | md5sum | cut -d' ' -f1) ;;
+    esac
+    printf '%%s %%s\n' "$m" "$f"
+done
+''' % dict(zero=ZERO_MD5)
+
+
+def id3_size(header):
+    # bytes taken by a leading ID3v2 tag, given the first 10 bytes of the file
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 10 + (header[6] << 21 | header[7] << 14 | header[8] << 7 | header[9])
+    return size + 10 if header[5] & 16 else size
+
+
+def audio_hash(path):
+    # tags don't count: FLAC has the decoded-audio MD5 in STREAMINFO (after any ID3v2 tag someone put in
+    # front), MP3 is hashed without ID3v2/ID3v1
+    with open(path, 'rb') as f:
+        start = id3_size(f.read(10))
+        if path.lower().endswith('.flac'):
+            f.seek(start)
+            block = f.read(42)
+            md5 = block[26:42].hex()
+            if block[:4] == b'fLaC' and len(md5) == 32 and md5 != ZERO_MD5:
+                return 'flac:' + md5
+            f.seek(0)
+            return 'md5:' + hashlib.file_digest(f, 'md5').hexdigest()
+
+        end = os.fstat(f.fileno()).st_size
+        if end >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+        md5 = hashlib.md5()
+        f.seek(start)
+        remaining = max(end - start, 0)
+        while remaining and (data := f.read(min(remaining, 1 << 20))):
+            md5.update(data)
+            remaining -= len(data)
+        return 'mp3:' + md5.hexdigest()
+
+
+def remote_hashes(shell, paths, batch=128):
+    hashes = {}
+    paths = list(paths)
+    for i in range(0, len(paths), batch):
+        command = 'set -- ' + ' '.join(map(adbshell.quote, paths[i:i + batch])) + '\n' + REMOTE_SCRIPT
+        for line in shell.run(command, stderr=False).output.split(b'\n'):
+            if line:
+                digest, path = line.split(b' ', 1)
+                hashes[os.fsdecode(path)] = digest.decode()
+    return hashes
+
+
+class Manifest:
+    # path -> size, mtime and audio hash; a hash is only trusted while size and mtime still match
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.dirty = False
+
+    def get(self, path, size, mtime):
+        entry = self.entries.get(path)
+        if entry and entry['size'] == size and int(entry['mtime']) == int(mtime) \
+                and entry.get('version') == HASH_VERSION:
+            return entry['hash']
+
+    def set(self, path, size, mtime, digest):
+        self.entries[path] = dict(size=size, mtime=int(mtime), hash=digest, version=HASH_VERSION)
+        self.dirty = True
+
+    def rename(self, src, dst):
+        if src in self.entries:
+            self.entries[dst] = self.entries.pop(src)
+            self.dirty = True
+
+    def prune(self, paths):
+        for path in set(self.entries) - set(paths):
+            del self.entries[path]
+            self.dirty = True
+
+    def by_hash(self):
+        index = {}
+        for path, entry in self.entries.items():
+            index.setdefault(entry['hash'], []).append(path)
+        return index
+
+    def dumps(self):
+        return json.dumps(self.entries, indent=1, sort_keys=True, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path=LOCAL_PATH):
+        try:
+            with open(path, encoding='utf-8', errors='surrogateescape') as f:
+                return cls(json.load(f))
+        except (FileNotFoundError, ValueError):
+            return cls()
+
+    def save(self, path=LOCAL_PATH):
+        if self.dirty:
+            with open(path + '.part', 'w', encoding='utf-8', errors='surrogateescape') as f:
+                f.write(self.dumps())
+            os.replace(path + '.part', path)
+            self.dirty = False
+
+    @classmethod
+    def load_remote(cls, shell, path=REMOTE_PATH):
+        result = shell.run('cat ' + adbshell.quote(path), stderr=False)
+        try:
+            return cls(json.loads(os.fsdecode(result.output))) if result.code == 0 else cls()
+        except ValueError:
+            return cls()
+
+    def save_remote(self, shell, path=REMOTE_PATH):
+        if self.dirty:
+            subprocess.run([adbshell.ADB, 'exec-in', 'cat > ' + adbshell.quote(path + '.part')],
+                           input=os.fsencode(self.dumps()), check=True)
+            shell.mv(path + '.part', path)
+            self.dirty = False
+
+
+def local_hashes(manifest, names):
+    # hashes for local files, reusing the manifest where size and mtime haven't moved
+    hashes = {}
+    for name in names:
+        st = os.stat(name)
+        digest = manifest.get(name, st.st_size, st.st_mtime)
+        if digest is None:
+            digest = audio_hash(name)
+            manifest.set(name, st.st_size, st.st_mtime, digest)
+        hashes[name] = digest
+    return hashes
+
+
+def remote_hashes_cached(manifest, shell, index, paths):
+    # index: path -> (mtime, size) as listed; only paths whose entry is stale go to the device
+    hashes, stale = {}, []
+    for path in paths:
+        mtime, size = index[path]
+        digest = manifest.get(path, size, mtime)
+        if digest is None:
+            stale.append(path)
+        else:
+            hashes[path] = digest
+    for path, digest in remote_hashes(shell, stale).items():
+        mtime, size = index[path]
+        manifest.set(path, size, mtime, digest)
+        hashes[path] = digest
+    return hashes
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('paths', nargs='+')
+    ap.add_argument('-r', '--remote', action='store_true', help='hash on the device instead')
+    args = ap.parse_args()
+    if args.remote:
+        with adbshell.Shell() as shell:
+            for path, digest in remote_hashes(shell, args.paths).items():
+                print(digest, path)
+    else:
+        for path in args.paths:
+            print(audio_hash(path), path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,20 @@
 #!/usr/bin/python
 
 
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
 import numpy as np
-import pyaudio
-import matplotlib.pyplot as plt
+import scipy.fft
+from numpy.lib.stride_tricks import sliding_window_view
+
+import decode
 
 
-chunk_size = 12000
-fs = 48000
-window_size = 48000
 smoothing_window_size = 384
 frequency_bins = 24000
 
@@ -16,58 +22,401 @@ frequency_bins = 24000
 # -24 dBFS = -5 dB (FFT)
 
 
-p = pyaudio.PyAudio()
-stream = p.open(format=pyaudio.paFloat32, channels=1, rate=fs, input=True, frames_per_buffer=chunk_size)
+class Spectrum:
+    # everything that only depends on the sizes is computed once here; per frame the
+    # only allocations left are the FFT outputs
+
+    def __init__(self, fs, window_size, frequency_bins, smoothing_window_size):
+        # mirrored ring buffer: every sample is stored twice so the latest window is always contiguous
+        self.ring = np.zeros(2 * window_size, np.float32)
+        self.pos = 0
+        self.window = np.hanning(window_size).astype(np.float32)
+        self.windowed = np.empty(window_size, np.float32)
+        self.magnitude = np.empty(window_size // 2 + 1, np.float32)
+
+        # linear interpolation onto the log grid as a fixed gather + lerp
+        fft_freq = np.fft.rfftfreq(window_size, 1 / fs)
+        self.freq = np.logspace(np.log10(20), np.log10(20000), frequency_bins)
+        upper = np.clip(np.searchsorted(fft_freq, self.freq), 1, len(fft_freq) - 1)
+        self.lower, self.upper = upper - 1, upper
+        self.weight = ((self.freq - fft_freq[upper - 1]) / (fft_freq[upper] - fft_freq[upper - 1])).astype(np.float32)
+        self.interpolated = np.empty(frequency_bins, np.float32)
+        self.delta = np.empty(frequency_bins, np.float32)
+
+        # blackman smoothing as a multiply by the precomputed kernel spectrum
+        kernel = np.blackman(smoothing_window_size)
+        self.fft_size = scipy.fft.next_fast_len(frequency_bins + smoothing_window_size - 1, real=True)
+        self.kernel = scipy.fft.rfft(kernel / kernel.sum(), self.fft_size).astype(np.complex64)
+        self.offset = (smoothing_window_size - 1) // 2
+        self.padded = np.zeros(self.fft_size, np.float32)
+        self.response = np.empty(frequency_bins, np.float32)
+
+    def push(self, chunk):
+        size = len(self.window)
+        while len(chunk):
+            n = min(len(chunk), size - self.pos)
+            self.ring[self.pos:self.pos + n] = chunk[:n]
+            self.ring[self.pos + size:self.pos + size + n] = chunk[:n]
+            self.pos = (self.pos + n) % size
+            chunk = chunk[n:]
+
+    def analyze(self):
+        np.multiply(self.ring[self.pos:self.pos + len(self.window)], self.window, out=self.windowed)
+        np.abs(scipy.fft.rfft(self.windowed, overwrite_x=True), out=self.magnitude)
+
+        np.take(self.magnitude, self.lower, out=self.interpolated)
+        np.take(self.magnitude, self.upper, out=self.delta)
+        np.subtract(self.delta, self.interpolated, out=self.delta)
+        np.multiply(self.delta, self.weight, out=self.delta)
+        np.add(self.interpolated, self.delta, out=self.padded[:len(self.interpolated)])
+
+        spectrum = scipy.fft.rfft(self.padded)
+        np.multiply(spectrum, self.kernel, out=spectrum)
+        smoothed = scipy.fft.irfft(spectrum, self.fft_size, overwrite_x=True)
+
+        np.maximum(smoothed[self.offset:self.offset + len(self.response)], 1e-10, out=self.response)  # avoid log(<=0)
+        np.log10(self.response, out=self.response)
+        np.multiply(self.response, 20, out=self.response)
+        return self.freq, self.response
+
+
+class Bands:
+    # fractional-octave bands (base 2, centred on 1 kHz) as power means over the log-spaced bins
+
+    def __init__(self, freq, fraction):
+        k = np.arange(np.floor(fraction * np.log2(freq[0] / 1000)), np.ceil(fraction * np.log2(freq[-1] / 1000)) + 1)
+        edges = 1000 * 2 ** ((k - 0.5) / fraction)
+        starts = np.unique(np.searchsorted(freq, edges))
+        starts = starts[starts < len(freq)]
+        self.starts = starts
+        self.counts = np.diff(np.append(starts, len(freq))).astype(np.float32)
+        self.edges = np.append(freq[starts], freq[-1])
+        self.power = np.empty(len(freq), np.float32)
+
+    def __call__(self, response):
+        np.multiply(response, np.float32(np.log(10) / 10), out=self.power)
+        np.exp(self.power, out=self.power)
+        levels = np.add.reduceat(self.power, self.starts) / self.counts
+        return 10 * np.log10(levels + 1e-10)
+
+
+class Traces:
+    # what gets drawn: the current spectrum (or bands), plus optional peak-hold and average
+
+    def __init__(self, bands, peak_decay, average):
+        self.bands = bands
+        self.peak_decay = peak_decay
+        self.average = average
+        self.peak = self.mean = None
+        self.last = None
+
+    def update(self, response, now):
+        current = self.bands(response) if self.bands else response
+        dt = now - self.last if self.last is not None else 0
+        self.last = now
+        if self.peak is None:
+            self.peak = current.copy()
+            self.mean = 10 ** (current / 10)
+        else:
+            if self.peak_decay:
+                self.peak -= self.peak_decay * dt
+            np.maximum(self.peak, current, out=self.peak)
+            if self.average:
+                self.mean += (10 ** (current / 10) - self.mean) * min(1, dt / self.average)
+        return current.copy(), self.peak.copy(), 10 * np.log10(self.mean + 1e-10)
+
+
+class Stats:
+    overflows = 0       # input overflows reported by PortAudio
+    dropped_chunks = 0  # captured chunks that found the queue full
+    dropped_frames = 0  # frames skipped to catch up or replaced before being drawn
+    latency = 0.0       # capture of the newest chunk -> frame on screen
+    finished = False    # file sources only
+
+
+class MicSource:
+    def __init__(self, rate, fps):
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.rate, self.chunk_size = rate, rate // fps
+        self.name = 'microphone'
+
+    def start(self, deliver):
+        pyaudio = self.pyaudio
+
+        def callback(in_data, frame_count, time_info, status):
+            # runs on the PortAudio thread: never block here
+            deliver(np.frombuffer(in_data, dtype=np.float32), bool(status & pyaudio.paInputOverflow))
+            return None, pyaudio.paContinue
+
+        self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(format=pyaudio.paFloat32, channels=1, rate=self.rate, input=True,
+                                  frames_per_buffer=self.chunk_size, stream_callback=callback)
+
+    def stop(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.p.terminate()
+
 
+class FileSource:
+    # replays a file at its own pace through the same path the microphone uses
 
-def apply_log_scale_and_smoothing(magnitude_spectrum, smoothing_window_size):
-    filter = np.blackman(smoothing_window_size)
-    magnitude_spectrum = np.convolve(magnitude_spectrum, filter / filter.sum(), mode='same')
-    magnitude_spectrum = 20 * np.log10(magnitude_spectrum + 1e-10)  # Add a small constant to avoid log(0)
-    return magnitude_spectrum
+    def __init__(self, path, fps):
+        self.decoder = decode.open_audio(path)
+        self.rate, self.chunk_size = self.decoder.rate, self.decoder.rate // fps
+        self.name = os.path.basename(path)
+        self.running = threading.Event()
 
+    def start(self, deliver, done):
+        self.running.set()
+        threading.Thread(target=self.replay, args=(deliver, done), daemon=True).start()
 
-audio_chunk = np.zeros(window_size, dtype=np.float32)
+    def replay(self, deliver, done):
+        start = time.monotonic()
+        frames = 0
+        with self.decoder:
+            for chunk in self.decoder.chunks(self.chunk_size):
+                if not self.running.is_set():
+                    return
+                frames += len(chunk)
+                delay = start + frames / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                deliver(chunk.mean(axis=1), False)
+        done()
 
-def get_response():
-    global audio_chunk
-    current_chunk = np.frombuffer(stream.read(chunk_size), dtype=np.float32)
-    audio_chunk = np.concatenate([audio_chunk, current_chunk], axis=0)[-window_size:]
-    windowed_chunk = audio_chunk * np.hanning(len(audio_chunk))
+    def stop(self):
+        self.running.clear()
 
-    fft_freq = np.fft.fftfreq(len(windowed_chunk), 1 / fs)
-    fft_result = np.fft.fft(windowed_chunk)
 
-    fft_freq = fft_freq[:len(fft_result) // 2]
-    fft_result = fft_result[:len(fft_result) // 2]
+class Pipeline:
+    # source -> bounded queue -> analysis thread -> latest frame, which the renderer picks up
 
-    new_freq = np.logspace(np.log10(20), np.log10(20000), frequency_bins)
-    fft_result = np.abs(fft_result)
-    new_result = np.interp(new_freq, fft_freq, fft_result)
+    def __init__(self, spectrum, traces):
+        self.spectrum, self.traces = spectrum, traces
+        self.stats = Stats()
+        self.chunks = queue.Queue(maxsize=64)
+        self.latest = None  # (frame number, capture time, traces), swapped in whole by the analysis thread
+        self.running = threading.Event()
 
-    magnitude_spectrum = apply_log_scale_and_smoothing(new_result, smoothing_window_size)
+    def deliver(self, chunk, overflow):
+        if overflow:
+            self.stats.overflows += 1
+        try:
+            self.chunks.put_nowait((time.monotonic(), chunk))
+        except queue.Full:
+            self.stats.dropped_chunks += 1
 
-    return new_freq, magnitude_spectrum
+    def finish(self):
+        self.stats.finished = True
 
+    def start(self):
+        self.running.set()
+        threading.Thread(target=self.run, daemon=True).start()
 
-plt.ion()
-fig, ax = plt.subplots()
-x, y = get_response()
-line, = ax.plot(x, y)
-ax.set_xlim(20, 20000)
-ax.set_xscale('log')
-ax.set_xlabel('Frequency [Hz]')
-ax.set_ylim(-60, 40)
-ax.set_ylabel('Magnitude [dB]')
+    def stop(self):
+        self.running.clear()
 
-for i in range(10000):
-    if not plt.fignum_exists(fig.number):  # type: ignore
-        break
-    x, y = get_response()
-    line.set_xdata(x)
-    line.set_ydata(y)
+    def run(self):
+        number = 0
+        while self.running.is_set():
+            try:
+                captured, chunk = self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            self.spectrum.push(chunk)
+            if not self.chunks.empty():
+                self.stats.dropped_frames += 1  # more input already waiting, catch up before analyzing
+                continue
+            _, response = self.spectrum.analyze()
+            number += 1
+            self.latest = (number, captured, self.traces.update(response, captured))
+
+
+def live(source, args):
+    import matplotlib.pyplot as plt
+
+    spectrum = Spectrum(source.rate, source.rate, frequency_bins, smoothing_window_size)
+    bands = Bands(spectrum.freq, args.octave) if args.octave else None
+    pipeline = Pipeline(spectrum, Traces(bands, args.peak_decay, args.average))
+    stats = pipeline.stats
+    pipeline.start()
+    if isinstance(source, FileSource):
+        source.start(pipeline.deliver, pipeline.finish)
+    else:
+        source.start(pipeline.deliver)
+
+    def trace(**kwargs):
+        if bands:
+            return ax.stairs(np.full(len(bands.starts), -60.0), bands.edges, baseline=-60, animated=True, **kwargs)
+        return ax.plot(spectrum.freq, np.full(frequency_bins, -60.0), animated=True, **kwargs)[0]
+
+    def set_trace(artist, values):
+        if bands:
+            artist.set_data(values)
+        else:
+            artist.set_ydata(values)
+
+    fig, ax = plt.subplots()
+    fig.canvas.manager.set_window_title(source.name)
+    artists = [trace(fill=True, label='current') if bands else trace(label='current')]
+    artists.append(trace(color='C3', lw=0.8, label='peak') if args.peak_hold else None)
+    artists.append(trace(color='C2', lw=1.2, label='average') if args.average else None)
+    status = ax.text(0.01, 0.99, '', transform=ax.transAxes, va='top', family='monospace', fontsize=8, animated=True)
+    ax.set_xlim(20, 20000)
+    ax.set_xscale('log')
+    ax.set_xlabel('Frequency [Hz]')
+    ax.set_ylim(-60, 40)
+    ax.set_ylabel('Magnitude [dB]')
+
+    # blitting: axes, ticks and labels are drawn once into the background, each frame only redraws the traces
+    background = None
+
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+        for artist in artists + [status]:
+            if artist is not None:
+                ax.draw_artist(artist)
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    plt.show(block=False)
     fig.canvas.draw()
-    fig.canvas.flush_events()
-    plt.pause(0.001)
 
-print("Figure closed, exiting.")
+    shown = 0
+    while plt.fignum_exists(fig.number):  # type: ignore
+        frame = pipeline.latest
+        if frame is None or frame[0] == shown or background is None:
+            fig.canvas.flush_events()
+            time.sleep(0.002)
+            continue
+        stats.dropped_frames += frame[0] - shown - 1
+        shown = frame[0]
+        fig.canvas.restore_region(background)
+        for artist, values in zip(artists, frame[2]):
+            if artist is not None:
+                set_trace(artist, values)
+                ax.draw_artist(artist)
+        stats.latency = time.monotonic() - frame[1]
+        status.set_text(f'overflows {stats.overflows}  dropped chunks {stats.dropped_chunks}'
+                        f'  dropped frames {stats.dropped_frames}  latency {stats.latency * 1000:.0f} ms'
+                        + ('  [end]' if stats.finished else ''))
+        ax.draw_artist(status)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+
+    pipeline.stop()
+    source.stop()
+    print("Figure closed, exiting.")
+
+
+def read_mono(path):
+    with decode.open_audio(path) as decoder:
+        audio = decoder.read()
+    return audio.mean(axis=1), decoder.rate
+
+
+def stft(audio, window_size, hop, block=256):
+    # frames are strided views into the signal; only `block` of them are windowed and copied at a time
+    if len(audio) < window_size:
+        audio = np.pad(audio, (0, window_size - len(audio)))
+    frames = sliding_window_view(audio, window_size)[::hop]
+    window = np.hanning(window_size).astype(np.float32)
+    scale = 2 / window.sum()
+    db = np.empty((len(frames), window_size // 2 + 1), np.float32)
+    for start in range(0, len(frames), block):
+        magnitude = np.abs(scipy.fft.rfft(frames[start:start + block] * window, axis=-1)) * scale
+        np.log10(np.maximum(magnitude, 1e-10), out=db[start:start + block])
+    db *= 20
+    return db
+
+
+def batch(path, args):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    audio, rate = read_mono(path)
+    decoded = time.perf_counter()
+    db = stft(audio, args.window, args.hop)
+    analyzed = time.perf_counter()
+    freq = np.fft.rfftfreq(args.window, 1 / rate)
+    times = (np.arange(len(db)) * args.hop + args.window / 2) / rate
+    mean = 10 * np.log10(np.mean(10 ** (db / 10), axis=0))
+
+    base = os.path.join(args.output or os.path.dirname(path), os.path.splitext(os.path.basename(path))[0])
+    np.savez_compressed(base + '.npz', freq=freq, time=times, db=db, mean=mean, rate=rate)
+
+    fig, (top, bottom) = plt.subplots(2, 1, figsize=(12, 8), sharex=True, height_ratios=(3, 1))
+    mesh = top.pcolormesh(freq[1:], times, db[:, 1:], shading='auto', cmap='magma', vmin=-120, vmax=0)
+    fig.colorbar(mesh, ax=(top, bottom), label='Magnitude [dBFS]')
+    top.set_ylabel('Time [s]')
+    top.set_title(os.path.basename(path))
+    bottom.plot(freq[1:], mean[1:])
+    bottom.set_xscale('log')
+    bottom.set_xlim(20, min(20000, rate / 2))
+    bottom.set_xlabel('Frequency [Hz]')
+    bottom.set_ylabel('Mean [dBFS]')
+    fig.savefig(base + '.png', dpi=100)
+    plt.close(fig)
+
+    seconds = len(audio) / rate
+    print(f'{path} | {len(db)} frames | decode {seconds / (decoded - start):.0f}x'
+          f' | stft {seconds / (analyzed - decoded):.0f}x | {base}.npz', file=sys.stderr)
+
+
+def bench(path, args):
+    # the live pipeline without capture or GUI: every hop analyzed, as fast as it goes
+    audio, rate = read_mono(path)
+    spectrum = Spectrum(rate, rate, frequency_bins, smoothing_window_size)
+    bands = Bands(spectrum.freq, args.octave) if args.octave else None
+    traces = Traces(bands, args.peak_decay, args.average)
+    hop = rate // args.fps
+    start = time.perf_counter()
+    n = 0
+    for n, offset in enumerate(range(0, len(audio) - hop + 1, hop), 1):
+        spectrum.push(audio[offset:offset + hop])
+        _, response = spectrum.analyze()
+        traces.update(response, offset / rate)
+    elapsed = time.perf_counter() - start
+    print(f'{path} | {n} frames | {n / elapsed:.0f} frames/s | {len(audio) / rate / elapsed:.1f}x realtime'
+          f' at {args.fps} fps')
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('paths', nargs='*', help='replay files instead of the microphone')
+    ap.add_argument('-o', '--octave', type=int, choices=(3, 6, 24), help='show 1/N-octave bands instead of the line')
+    ap.add_argument('-p', '--peak-hold', action='store_true')
+    ap.add_argument('--peak-decay', type=float, default=0, help='dB/s, 0 holds forever')
+    ap.add_argument('-a', '--average', type=float, default=0, metavar='SECONDS', help='long-term average time constant')
+    ap.add_argument('--fps', type=int, default=60)
+    ap.add_argument('--rate', type=int, default=48000, help='microphone sample rate')
+    ap.add_argument('-b', '--batch', action='store_true', help='write a spectrogram .npz/.png per file, no GUI')
+    ap.add_argument('--bench', action='store_true', help='time the live analysis over each file, no GUI')
+    ap.add_argument('-O', '--output', help='directory for batch output, default next to each file')
+    ap.add_argument('--window', type=int, default=4096, help='batch STFT window')
+    ap.add_argument('--hop', type=int, default=1024, help='batch STFT hop')
+    args = ap.parse_args()
+
+    if (args.batch or args.bench) and not args.paths:
+        ap.error('--batch and --bench need files')
+    if args.batch:
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+        for path in args.paths:
+            batch(path, args)
+    elif args.bench:
+        for path in args.paths:
+            bench(path, args)
+    elif args.paths:
+        for path in args.paths:
+            live(FileSource(path, args.fps), args)
+    else:
+        live(MicSource(args.rate, args.fps), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,106 @@
 #!/usr/bin/python
 
-import subprocess
+import argparse
+import fnmatch
 import os
 import glob
+import sys
+import time
 
-names = glob.glob('*.poweramp-backup') + glob.glob('*.flac') + glob.glob('*.mp3')
+import adbshell
+import library
+import transfer
 
-subprocess.check_call(['adb', 'shell', 'mkdir', '-p', 'storage/emulated/0/song'])
+PATTERNS = ('*.poweramp-backup', '*.flac', '*.mp3', '*.opus', '*.m4a')
+REMOTE_DIR = 'storage/emulated/0/song'
 
-existing_paths = subprocess.check_output(['adb', 'shell', 'ls', 'storage/emulated/0/song/*.{flac,mp3}']).decode().split('\n')
-existing_names = []
-for path in existing_paths:
-    name = os.path.basename(path)
-    existing_names.append(name)
+sys.stdout.reconfigure(errors='surrogateescape')
 
-for name in names:
-    if name not in existing_names:
-        print('Pushing', name)
-        subprocess.check_call(['adb', 'push', name, 'storage/emulated/0/song/' + name])
-    else:
-        print('Skipping', name)
+ap = argparse.ArgumentParser()
+ap.add_argument('-j', '--jobs', type=int, default=4, help='parallel transfers')
+ap.add_argument('-w', '--watch', action='store_true', help='keep running and push new files as they appear')
+ap.add_argument('--where', help='only audio files the library index matches, see library.py')
+ap.add_argument('--debounce', type=float, default=2, help='seconds a file has to stay unchanged before it is pushed')
+args = ap.parse_args()
+
+
+def listdir():
+    names = [name for pattern in PATTERNS for name in glob.glob(pattern)]
+    return selected(names) if args.where else names
+
+
+def selected(names):
+    try:
+        matching = {os.path.basename(path) for path in library.select(args.where, ['.'], recursive=False)}
+    except ValueError as e:
+        ap.error(str(e))
+    return [name for name in names if name in matching]
+
+
+def push(names):
+    jobs = []
+    for name in names:
+        if name not in existing:
+            print('Pushing', name)
+            jobs.append(transfer.Job('push', name, REMOTE_DIR + '/' + name, os.stat(name).st_size))
+        else:
+            print('Skipping', name)
+
+    failed = transfer.run(jobs, workers=args.jobs, compress=False, shell=shell)
+    existing.update(job.src for job in jobs)
+    existing.difference_update(job.src for job, _ in failed)
+    return failed
+
+
+watcher = None
+if args.watch:
+    import watch
+    # before the first listing, so nothing written in between is missed
+    watcher = watch.Watcher('.', watch.IN_CLOSE_WRITE | watch.IN_MOVED_TO | watch.IN_MODIFY | watch.IN_CREATE)
+
+names = listdir()  # first, so a bad --where stops us before adb is touched
+shell = adbshell.Shell()
+shell.mkdir(REMOTE_DIR)
+
+# the device is listed once; after that the index is kept up to date from what we push
+existing = {os.path.basename(path) for path, _, _ in shell.find(REMOTE_DIR + '/*.{flac,mp3,opus,m4a,poweramp-backup}')}
+failed = push(names)
+
+if watcher is not None:
+    pending = {}  # name -> (size at the last look, time of the last event or size change)
+    try:
+        while True:
+            events = watcher.read(timeout=args.debounce / 2)
+            now = time.monotonic()
+            if any(mask & watch.IN_Q_OVERFLOW for mask, _ in events):
+                events += [(0, name) for name in listdir()]  # missed events: fall back to a local rescan
+            for mask, name in events:
+                if name not in existing and any(fnmatch.fnmatch(name, pattern) for pattern in PATTERNS):
+                    pending[name] = (pending.get(name, (None, None))[0], now)
+
+            ready = []
+            for name, (size, seen) in list(pending.items()):
+                if now - seen < args.debounce:
+                    continue
+                try:
+                    current = os.stat(name).st_size
+                except FileNotFoundError:
+                    del pending[name]
+                    continue
+                if current != size:
+                    pending[name] = (current, now)  # still growing, look again after another debounce
+                    continue
+                del pending[name]
+                ready.append(name)
+            if ready and args.where:
+                ready = selected(ready)
+            if ready:
+                push(sorted(ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+shell.close()
+if failed:
+    raise SystemExit(f'{len(failed)} pushes failed')
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+import decode
+import lufs
+
+MANIFEST = '.render.json'
+MANIFEST_FIELDS = ('src', 'size', 'mtime', 'hash', 'settings')
+VERSION = 1  # bump when the rendering itself changes, so every output is redone
+
+# extension, encoder arguments, default bitrate
+CODECS = {
+    'opus': ('.opus', ['-c:a', 'libopus', '-ar', '48000', '-f', 'opus'], '160k'),
+    'aac': ('.m4a', ['-c:a', 'aac', '-f', 'ipod'], '256k'),
+    'mp3': ('.mp3', ['-c:a', 'libmp3lame', '-f', 'mp3'], '320k'),
+    'flac': ('.flac', ['-c:a', 'flac', '-f', 'flac'], None),
+}
+
+# the gain is baked in, players must not apply it again
+CLEARED_TAGS = ('REPLAYGAIN_TRACK_GAIN', 'REPLAYGAIN_TRACK_PEAK', 'REPLAYGAIN_ALBUM_GAIN', 'REPLAYGAIN_ALBUM_PEAK')
+
+
+def encoder_command(src, dst, rate, channels, bits, settings):
+    _, args, bitrate = CODECS[settings['codec']]
+    bitrate = settings['bitrate'] or bitrate
+    if bitrate:
+        args = args + ['-b:a', bitrate]
+    if settings['codec'] == 'flac':
+        args = args + ['-sample_fmt', 's16' if (bits or 16) <= 16 else 's32']
+    # input 0 is the gained PCM on stdin, input 1 the source again, only for its tags
+    cleared = [arg for tag in CLEARED_TAGS for arg in ('-metadata', f'{tag}=')]
+    return [decode.FFMPEG, '-v', 'error', '-y', '-f', 'f32le', '-ar', str(rate), '-ac', str(channels), '-i', 'pipe:0',
+            '-i', src, '-map', '0:a', '-map_metadata', '1', *cleared, *args, dst]
+
+
+def render(job):
+    # decode -> gain -> ffmpeg stdin; the only file written is the output itself
+    src, dst, settings, digest = job['src'], job['dst'], job['settings'], job.get('hash')
+    if digest is None:
+        digest = lufs.file_hash(src)
+        if digest == job.get('old_hash') and os.path.exists(dst):
+            return dict(job, hash=digest, status='unchanged')
+
+    info = lufs.analyze(src)
+    loudness = info['lufs'] if info['lufs'] is not None and np.isfinite(info['lufs']) else settings['target']
+    gain = lufs.clamp_gain(settings['target'] - loudness, info['true_peak'], settings['ceiling'])
+    scale = np.float32(10 ** (gain / 20))
+
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    part = dst + '.part'
+    with decode.open_audio(src) as decoder, tempfile.TemporaryFile() as errors:
+        proc = subprocess.Popen(encoder_command(src, part, decoder.rate, decoder.channels, decoder.bits, settings),
+                                stdin=subprocess.PIPE, stderr=errors)
+        try:
+            for chunk in decoder:
+                chunk *= scale
+                proc.stdin.write(chunk)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if proc.wait():
+            errors.seek(0)
+            if os.path.exists(part):
+                os.unlink(part)
+            raise RuntimeError(errors.read().decode(errors='replace').strip() or f'ffmpeg exited {proc.returncode}')
+    os.replace(part, dst)
+    return dict(job, hash=digest, gain=gain, lufs=info['lufs'], status='rendered')
+
+
+def run_task(job):
+    try:
+        return render(job)
+    except Exception as e:
+        return dict(job, error=f'{type(e).__name__}: {e}')
+
+
+def load_manifest(staging):
+    try:
+        with open(os.path.join(staging, MANIFEST), encoding='utf-8', errors='surrogateescape') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(staging, manifest):
+    path = os.path.join(staging, MANIFEST)
+    with open(path + '.part', 'w', encoding='utf-8', errors='surrogateescape') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True, ensure_ascii=False)
+    os.replace(path + '.part', path)
+
+
+def plan(paths, staging, settings):
+    # (source, output) pairs; directories keep their layout under the staging root, which is left out
+    # of the walk when it sits inside a source tree
+    ext = CODECS[settings['codec']][0]
+    outputs = os.path.join(os.path.realpath(staging), '')
+    for path in paths:
+        base = path if os.path.isdir(path) else os.path.dirname(path)
+        for src in lufs.find_audio([path]):
+            if os.path.realpath(src).startswith(outputs):
+                continue
+            rel = os.path.splitext(os.path.relpath(src, base))[0] + ext
+            yield src, os.path.join(staging, rel), rel
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('paths', nargs='*', default=['.'])
+    ap.add_argument('-o', '--output', required=True, help='staging directory')
+    ap.add_argument('-C', '--codec', choices=CODECS, default='opus')
+    ap.add_argument('-b', '--bitrate', help='encoder bitrate, e.g. 128k')
+    ap.add_argument('-t', '--target', type=float, default=-20)
+    # the gain is baked into the samples, anything over full scale would clip in the encoder
+    ap.add_argument('-c', '--ceiling', type=float, default=-1,
+                    help='limit gain so the true peak stays below this dBTP (default %(default)s)')
+    ap.add_argument('-j', '--jobs', type=int, default=max(1, multiprocessing.cpu_count() // 2))
+    ap.add_argument('--prune', action='store_true', help='delete outputs whose source is gone')
+    args = ap.parse_intermixed_args()
+
+    settings = dict(version=VERSION, codec=args.codec, bitrate=args.bitrate, target=args.target, ceiling=args.ceiling)
+    os.makedirs(args.output, exist_ok=True)
+    manifest = load_manifest(args.output)
+
+    jobs, seen, skipped, failed = [], {}, 0, 0
+    for src, dst, rel in plan(args.paths, args.output, settings):
+        if rel in seen:
+            # song.flac next to song.mp3: both would render to the same file
+            failed += 1
+            print(f'{src} | same output {rel} as {seen[rel]}', file=sys.stderr)
+            continue
+        seen[rel] = src
+        st = os.stat(src)
+        entry = manifest.get(rel)
+        job = dict(src=src, dst=dst, rel=rel, settings=settings, size=st.st_size, mtime=st.st_mtime_ns)
+        if entry and entry['settings'] == settings and os.path.exists(dst):
+            if (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime_ns):
+                skipped += 1
+                continue
+            job['old_hash'] = entry['hash']  # touched but maybe not changed: the worker hashes to find out
+        jobs.append(job)
+
+    if args.prune:
+        for rel in set(manifest) - seen:
+            try:
+                os.unlink(os.path.join(args.output, rel))
+            except FileNotFoundError:
+                pass
+            del manifest[rel]
+            print('Pruned', rel)
+
+    jobs.sort(key=lambda job: job['size'], reverse=True)
+    start = time.monotonic()
+    rendered = 0
+    try:
+        with multiprocessing.Pool(args.jobs, initializer=lufs.init_worker, initargs=(False,)) as pool, \
+                tqdm(total=sum(job['size'] for job in jobs), unit='B', unit_scale=True, unit_divisor=1024,
+                     leave=False) as bar:
+            try:
+                for record in pool.imap_unordered(run_task, jobs):
+                    if 'error' in record:
+                        failed += 1
+                        tqdm.write(f'{record["src"]} | {record["error"]}', file=sys.stderr)
+                    else:
+                        manifest[record['rel']] = {key: record[key] for key in MANIFEST_FIELDS}
+                        if record['status'] == 'rendered':
+                            rendered += 1
+                            tqdm.write(f'{record["rel"]} | Gain {record["gain"]:+.2f} dB')
+                        else:
+                            skipped += 1
+                    bar.update(record['size'])
+            except KeyboardInterrupt:
+                pool.terminate()
+                bar.close()
+                print('Interrupted', file=sys.stderr)
+                sys.exit(130)
+    finally:
+        save_manifest(args.output, manifest)
+
+    print(f'{rendered} rendered, {skipped} unchanged, {time.monotonic() - start:.1f}s'
+          + (f', {failed} failed' if failed else ''), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
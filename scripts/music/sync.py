@@ -4,10 +4,17 @@
 $num($add(10000,$replace($replace(%replaygain_track_gain%,.,),dB,)),8)
 '''
 
-import subprocess
 import argparse
-import shlex
+import glob
 import os
+import sys
+
+import adbshell
+import manifest
+import transfer
+
+# names the device hands us are not always valid UTF-8; print them back byte for byte
+sys.stdout.reconfigure(errors='surrogateescape')
 
 ap = argparse.ArgumentParser()
 ap.add_argument('-c', '--create', action='store_true')
@@ -16,6 +23,8 @@ ap.add_argument('-d', '--download', action='store_true')
 ap.add_argument('-u', '--upload', action='store_true')
 ap.add_argument('-r', '--remove', action='store_true')
 ap.add_argument('-C', '--upload-create', action='store_true')
+ap.add_argument('-j', '--jobs', type=int, default=4, help='parallel transfers')
+ap.add_argument('--tar', action='store_true', help='stream files in bulk through tar, singles only for what fails')
 args = ap.parse_args()
 
 if 1:
@@ -41,62 +50,109 @@ local_dirs = [
     '*.{flac,mp3}',
 ]
 
-try:
-    paths = subprocess.check_output(['adb', 'shell', 'ls', *remote_dirs]).decode().split('\n')
-except UnicodeDecodeError as e:
-    code = subprocess.check_output(['adb', 'shell', 'ls', *remote_dirs])
-    code = code.decode('utf-8', 'replace')
-    i = code.find('\ufffd')
-    if i != -1:
-        print(i, code[max(0,i-50):i+50])
-    raise e
 
-visited = set()
-for path in paths:
-    if not path:
-        continue
+def expand(pattern):
+    return [name for alternative in adbshell.braces(pattern) for name in glob.glob(alternative)]
+
+
+shell = adbshell.Shell()
+# one streamed listing: names come NUL-separated and stay bytes-faithful (surrogateescape) throughout
+remote = {path: (mtime, size) for path, mtime, size in shell.find(*remote_dirs)}
+names = sorted({name for pattern in local_dirs for name in expand(pattern)})
+
+eps = 5
+remote_names = {os.path.basename(path) for path in remote}
+remote_only = [path for path in remote if not os.path.exists(os.path.basename(path))]
+local_only = [name for name in names if name not in remote_names]
+changed = [path for path in set(remote) - set(remote_only)
+           if abs(remote[path][0] - os.stat(os.path.basename(path)).st_mtime) > eps]
+
+# audio hashes (tags excluded) only for what could be a rename or a tag-only edit; both manifests
+# remember them until size or mtime change
+local_manifest = manifest.Manifest.load()
+remote_manifest = manifest.Manifest.load_remote(shell)
+renamed_from = remote_only if local_only else []
+renamed_to = local_only if remote_only else []
+hashed = renamed_from + changed
+remote_hashes = manifest.remote_hashes_cached(remote_manifest, shell, remote, hashed) if hashed else {}
+local_hashes = manifest.local_hashes(local_manifest, renamed_to + [os.path.basename(path) for path in changed])
+
+renames = {}
+unclaimed = {}
+for name in renamed_to:
+    if local_hashes[name] not in manifest.EMPTY_HASHES:
+        unclaimed.setdefault(local_hashes[name], name)
+for path in renamed_from:
+    if (name := unclaimed.pop(remote_hashes.get(path), None)) is not None:
+        renames[path] = name
 
+visited = set()
+moved = set()
+jobs = []
+for path, (mtime, size) in sorted(remote.items()):
     name = os.path.basename(path)
     visited.add(name)
 
+    if path in renames:
+        new = renames[path]
+        visited.add(new)
+        print('[~]', name, '->', new)
+        if args.upload_create:
+            shell.mv(path, os.path.join(os.path.dirname(path), new))
+            remote_manifest.rename(path, os.path.join(os.path.dirname(path), new))
+            moved.add(os.path.join(os.path.dirname(path), new))
+        elif args.create:
+            os.rename(new, name)
+            local_manifest.rename(new, name)
+        continue
+
     if not os.path.exists(name):
         print('[+]', name)
         if args.create:
-            subprocess.check_call(['adb', 'pull', '-z', 'any', path, name])
+            jobs.append(transfer.Job('pull', path, name, size, mtime))
         if args.upload_remove:
-            # subprocess.check_call(['adb', 'shell', 'mv', shlex.quote(path), shlex.quote(path + '.backup')])
-            subprocess.check_call(['adb', 'shell', 'rm', shlex.quote(path)])
+            # shell.mv(path, path + '.backup')
+            shell.rm(path)
 
     else:
-        mtime = float(subprocess.check_output(['adb', 'shell', 'stat', '-c', '%Y', shlex.quote(path)]).strip())
-
-        eps = 5
-        dt = mtime - os.stat(name).st_mtime
+        st = os.stat(name)
+        dt = mtime - st.st_mtime
+        # same audio on both sides: only the tags moved
+        tags = ['tags'] if path in remote_hashes and remote_hashes[path] == local_hashes.get(name) else []
 
         if dt > eps:
-            print('[v]', name, int(dt))
+            print('[v]', name, int(dt), *tags)
             if args.download:
-                subprocess.check_call(['adb', 'pull', '-z', 'any', path, name])
+                jobs.append(transfer.Job('pull', path, name, size, mtime))
             continue
 
         if dt < -eps:
-            print('[^]', name, int(dt))
+            print('[^]', name, int(dt), *tags)
             if args.upload:
-                subprocess.check_call(['adb', 'push', '-z', 'any', name, path])
+                jobs.append(transfer.Job('push', name, path, st.st_size))
             continue
 
-        print('[ ]', name)
+        if size != st.st_size:
+            # same time but different content: nothing says which side is right
+            print('[!]', name, size - st.st_size)
+            continue
 
-names = subprocess.check_output(['sh', '-c', 'ls ' + ' '.join(local_dirs)]).decode().split('\n')
+        print('[ ]', name)
 
 for name in names:
-    if not name:
-        continue
-
     if name not in visited:
         print('[-]', name)
         if args.upload_create:
             path = remote_dir + '/' + name
-            subprocess.check_call(['adb', 'push', '-z', 'any', name, path])
+            jobs.append(transfer.Job('push', name, path, os.stat(name).st_size))
         if args.remove:
             os.unlink(name)
+
+failed = transfer.run(jobs, workers=args.jobs, shell=shell, tar=args.tar)
+local_manifest.prune(os.listdir('.'))
+local_manifest.save()
+remote_manifest.prune(set(remote) | moved)
+remote_manifest.save_remote(shell)
+shell.close()
+if failed:
+    raise SystemExit(f'{len(failed)} of {len(jobs)} transfers failed')
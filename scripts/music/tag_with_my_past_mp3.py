@@ -10,7 +10,11 @@ import argparse
 import re
 
 
-def iter_mp3_files(directory: Path) -> Iterable[Path]:
+def iter_mp3_files(directory: Path, where: str | None = None) -> Iterable[Path]:
+    if where:
+        import library
+
+        return [Path(p) for p in library.select(where, [str(directory)], recursive=False, extensions=(".mp3",))]
     return sorted(p for p in directory.glob("*.mp3") if p.is_file())
 
 
@@ -83,6 +87,11 @@ def main() -> None:
         default="With My Past OST",
         help="Album title to write.",
     )
+    parser.add_argument(
+        "--where",
+        type=str,
+        help="Only tag the MP3s the library index matches (SQL condition, see library.py).",
+    )
     args = parser.parse_args()
 
     script_dir = Path(__file__).resolve().parent
@@ -90,7 +99,10 @@ def main() -> None:
     cover_path: Path = (args.cover if args.cover.is_absolute() else (script_dir / args.cover)).resolve()
 
     cover_bytes = cover_path.read_bytes()
-    files = list(iter_mp3_files(mp3_dir))
+    try:
+        files = list(iter_mp3_files(mp3_dir, args.where))
+    except ValueError as e:
+        parser.error(str(e))
 
     for mp3_path in tqdm(files, desc="Tagging MP3s", unit="file"):
         track_number, title = parse_track_and_title(mp3_path)
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+import collections
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+import tqdm
+
+import adbshell
+
+Job = collections.namedtuple('Job', 'action src dst size mtime', defaults=(0, None))
+
+SUFFIX = '.part'
+
+
+class TransferError(Exception):
+    pass
+
+
+def adb(*args):
+    result = subprocess.run([adbshell.ADB, *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode:
+        raise TransferError(result.stderr.decode(errors='replace').strip() or f'adb {args[0]} exited {result.returncode}')
+
+
+def pull(job, compress, shell):
+    # -a keeps the device mtime, so the next comparison sees the file as in sync
+    adb('pull', '-a', *(['-z', 'any'] if compress else []), job.src, job.dst + SUFFIX)
+    os.replace(job.dst + SUFFIX, job.dst)
+
+
+def push(job, compress, shell):
+    # adb push carries the local mtime over
+    adb('push', *(['-z', 'any'] if compress else []), job.src, job.dst + SUFFIX)
+    shell.mv(job.dst + SUFFIX, job.dst)
+
+
+ACTIONS = {'pull': pull, 'push': push}
+
+
+def done(job, eps=2):
+    # a finished pull from an interrupted run is already renamed into place with the remote mtime
+    if job.action != 'pull' or job.mtime is None:
+        return False
+    try:
+        st = os.stat(job.dst)
+    except FileNotFoundError:
+        return False
+    return st.st_size == job.size and abs(st.st_mtime - job.mtime) <= eps
+
+
+def interleave(jobs):
+    # largest, smallest, next largest, ...: big files keep the link busy while small ones fill the gaps
+    queue = collections.deque(sorted(jobs, key=lambda job: job.size, reverse=True))
+    while queue:
+        yield queue.popleft()
+        if queue:
+            yield queue.pop()
+
+
+def attempt(job, compress, shell, retries, backoff):
+    for i in range(retries + 1):
+        try:
+            return ACTIONS[job.action](job, compress, shell)
+        except (TransferError, adbshell.ShellError, ConnectionError, OSError):
+            if i == retries:
+                raise
+            time.sleep(backoff * 2 ** i)
+
+
+def batches(jobs, max_bytes=256 << 20, max_files=256):
+    # small enough that one unreadable file only costs a batch, big enough to keep the link saturated
+    batch, size = [], 0
+    for job in jobs:
+        if batch and (size + job.size > max_bytes or len(batch) == max_files):
+            yield batch
+            batch, size = [], 0
+        batch.append(job)
+        size += job.size
+    if batch:
+        yield batch
+
+
+def tar_pull(batch, shell, bar):
+    wanted = {job.src.lstrip('/'): job for job in batch}
+    # adbd starts commands in /, so the relative device paths resolve as they do for the shell
+    command = 'tar -cf - ' + ' '.join(map(adbshell.quote, wanted)) + ' 2>/dev/null'
+    proc = subprocess.Popen([adbshell.ADB, 'exec-out', command], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            for member in tar:
+                job = wanted.pop(member.name, None)
+                if job is None or not member.isfile():
+                    continue
+                with tar.extractfile(member) as src, open(job.dst + SUFFIX, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                os.utime(job.dst + SUFFIX, (member.mtime, member.mtime))
+                os.replace(job.dst + SUFFIX, job.dst)
+                bar.update(job.size)
+    except (tarfile.TarError, OSError) as e:
+        bar.write(f'[x] tar stream broke off: {e}')
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+    return list(wanted.values())
+
+
+def tar_push(batch, shell, bar):
+    # members land under their .part names; only the ones that arrived whole get renamed
+    proc = subprocess.Popen([adbshell.ADB, 'exec-in', 'tar -xf -'], stdin=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    sent, left = [], []
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            for job in batch:
+                try:
+                    tar.add(job.src, arcname=job.dst.lstrip('/') + SUFFIX, recursive=False)
+                except OSError as e:
+                    bar.write(f'[x] {job.src}: {e}')
+                    left.append(job)
+                    continue
+                sent.append(job)
+        proc.stdin.close()
+    except (tarfile.TarError, OSError) as e:
+        bar.write(f'[x] tar stream broke off: {e}')
+    proc.wait()
+
+    if sent:
+        arrived = shell.stat(*(adbshell.quote(job.dst + SUFFIX) for job in sent))
+        moves = [(i, job) for i, job in enumerate(sent) if arrived.get(job.dst + SUFFIX, (0, -1))[1] == job.size]
+        output = shell.run('; '.join(f'mv {adbshell.quote(job.dst + SUFFIX)} {adbshell.quote(job.dst)} && echo {i}'
+                                     for i, job in moves)).output if moves else b''
+        moved = {int(line) for line in output.split() if line.isdigit()}
+        for i, job in enumerate(sent):
+            if i in moved:
+                bar.update(job.size)
+            else:
+                left.append(job)
+    return left
+
+
+TAR = {'pull': tar_pull, 'push': tar_push}
+
+
+def bulk(jobs, shell, bar):
+    # whatever doesn't make it through a tar stream comes back for the one-file-per-call path
+    left = []
+    for action, stream in TAR.items():
+        for batch in batches([job for job in jobs if job.action == action]):
+            left += stream(batch, shell, bar)
+    return left
+
+
+def run(jobs, workers=4, retries=3, backoff=1.0, compress=True, shell=None, tar=False):
+    jobs = [job for job in jobs if not done(job)]
+    if not jobs:
+        return []
+    owned = shell is None and any(job.action == 'push' for job in jobs)
+    if owned:
+        shell = adbshell.Shell()
+    failed = []
+    pool = concurrent.futures.ThreadPoolExecutor(workers)
+    try:
+        with tqdm.tqdm(total=sum(job.size for job in jobs), unit='B', unit_scale=True, unit_divisor=1024,
+                       smoothing=0.1, dynamic_ncols=True) as bar:
+            if tar:
+                jobs = bulk(jobs, shell, bar)
+            futures = {pool.submit(attempt, job, compress, shell, retries, backoff): job for job in interleave(jobs)}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append((job, e))
+                    bar.write(f'[x] {job.src}: {e}')
+                bar.update(job.size)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if owned:
+            shell.close()
+    return failed
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+EVENT = struct.Struct('iIII')
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class Watcher:
+    # a single-directory inotify watch through libc, no third-party package needed
+
+    def __init__(self, path, mask):
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, timeout=None):
+        # [(mask, name)] for whatever arrived within timeout seconds, [] if nothing did
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            events.append((mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+            offset += length
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else '.'
+    with Watcher(path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE) as watcher:
+        while True:
+            for mask, name in watcher.read():
+                print(f'{mask:#010x} {name}', flush=True)
+
+
+if __name__ == '__main__':
+    main()